@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+import click
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+from werkzeug.wrappers import Request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_FOLDER = 'dist'
+MANIFEST = 'manifest.json'
+STATIC_REFERENCE = re.compile(r"""url_for\(\s*['"]static['"]\s*,\s*filename\s*=\s*['"]([^'"]+)['"]\s*\)""")
+
+# Encodings served from precompressed files, in order of preference.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+ONE_YEAR = 365 * 24 * 3600
+
+
+def referenced_assets(template_folder):
+    assets = set()
+    for name in sorted(os.listdir(template_folder)):
+        if name.endswith('.html'):
+            with open(os.path.join(template_folder, name), encoding='utf-8') as f:
+                assets.update(STATIC_REFERENCE.findall(f.read()))
+    return sorted(assets)
+
+
+def hashed_name(filename, content):
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{digest}{ext}"
+
+
+def build(static_folder, template_folder):
+    dist = os.path.join(static_folder, DIST_FOLDER)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for filename in referenced_assets(template_folder):
+        source = os.path.join(static_folder, filename)
+        if not os.path.isfile(source):
+            continue
+        with open(source, 'rb') as f:
+            content = f.read()
+        target_name = hashed_name(filename, content)
+        target = os.path.join(dist, target_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+
+        compressed = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed['.br'] = brotli.compress(content, quality=11)
+        for suffix, data in compressed.items():
+            if len(data) < len(content):
+                with open(target + suffix, 'wb') as f:
+                    f.write(data)
+
+        manifest[filename] = f"{DIST_FOLDER}/{target_name}"
+
+    os.makedirs(dist, exist_ok=True)
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    path = os.path.join(static_folder, DIST_FOLDER, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+class PrecompressedStatic:
+    """WSGI middleware serving fingerprinted assets with their precompressed variants.
+
+    Files under the dist folder never change once built, so they are sent with an
+    immutable, one year Cache-Control header. The manifest, rewritten by every build,
+    is left to the static view.
+    """
+
+    def __init__(self, app, static_folder, static_url_path='/static'):
+        self.app = app
+        self.root = os.path.join(static_folder, DIST_FOLDER)
+        self.prefix = f"{static_url_path}/{DIST_FOLDER}/"
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        # The manifest keeps its name from one build to the next, it is not immutable.
+        if not path.startswith(self.prefix) or path[len(self.prefix):] == MANIFEST:
+            return self.app(environ, start_response)
+
+        filename = safe_join(self.root, path[len(self.prefix):])
+        if filename is None or not os.path.isfile(filename):
+            return self.app(environ, start_response)
+
+        request = Request(environ)
+        encoding = None
+        served = filename
+        for name, suffix in ENCODINGS:
+            if request.accept_encodings[name] and os.path.isfile(filename + suffix):
+                encoding = name
+                served = filename + suffix
+                break
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = send_file(served, environ, mimetype=mimetype, max_age=ONE_YEAR, conditional=True,
+                             etag=True)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.content_encoding = encoding
+        return response(environ, start_response)
+
+
+def init_app(app):
+    manifest = load_manifest(app.static_folder)
+    app.config['ASSET_MANIFEST'] = manifest
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == 'static':
+            filename = app.config['ASSET_MANIFEST'].get(values.get('filename'))
+            if filename is not None:
+                values['filename'] = filename
+
+    app.wsgi_app = PrecompressedStatic(app.wsgi_app, app.static_folder, app.static_url_path)
+
+    @app.cli.command("build-assets")
+    def build_assets():
+        """Fingerprint and precompress the static files referenced by the templates."""
+        manifest = build(app.static_folder, os.path.join(app.root_path, app.template_folder))
+        app.config['ASSET_MANIFEST'] = manifest
+        for source, target in manifest.items():
+            click.echo(f"{source} -> {target}")
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from functools import lru_cache
+from urllib.parse import urlencode
+
+from flask import abort, current_app, send_file
+
+import metrics
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+# Only the sizes the templates ask for, each one is another file per user in the cache.
+SIZES = (100,)
+EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif', 'image/svg+xml': 'svg'}
+MIMETYPES = {extension: mimetype for mimetype, extension in EXTENSIONS.items()}
+GRID = 5
+
+
+@lru_cache(maxsize=4096)
+def email_hash(email):
+    return hashlib.sha256(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+def identicon(digest, size):
+    """Symmetric 5x5 SVG pattern coloured from the hash, like the ones gravatar draws."""
+    data = bytes.fromhex(digest)
+    hue = int.from_bytes(data[:2], 'big') % 360
+    cell = size / GRID
+    rects = []
+    for row in range(GRID):
+        for column in range((GRID + 1) // 2):
+            if data[2 + row * 3 + column] % 2:
+                continue
+            for x in {column, GRID - 1 - column}:
+                rects.append(f'<rect x="{x * cell:.2f}" y="{row * cell:.2f}" width="{cell:.2f}" height="{cell:.2f}"/>')
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" viewBox="0 0 {size} {size}">'
+            f'<rect width="{size}" height="{size}" fill="#f0f0f0"/>'
+            f'<g fill="hsl({hue}, 55%, 50%)">{"".join(rects)}</g></svg>').encode()
+
+
+def cached_path(digest, size):
+    folder = current_app.config['AVATAR_CACHE_DIR']
+    for extension in MIMETYPES:
+        path = os.path.join(folder, f"{digest}-{size}.{extension}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def store(digest, size, extension, body):
+    folder = current_app.config['AVATAR_CACHE_DIR']
+    for old_extension in MIMETYPES:
+        if old_extension != extension:
+            try:
+                os.remove(os.path.join(folder, f"{digest}-{size}.{old_extension}"))
+            except FileNotFoundError:
+                pass
+    path = os.path.join(folder, f"{digest}-{size}.{extension}")
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+    return path
+
+
+def fetch(digest, size):
+    # Returns (extension, body) from the origin, None when the origin has no picture for this hash.
+    query = urlencode({'s': size, 'r': current_app.config['AVATAR_RATING'], 'd': '404'})
+    url = f"{current_app.config['AVATAR_ORIGIN'].rstrip('/')}/{digest}?{query}"
+    try:
+        with urllib.request.urlopen(url, timeout=current_app.config['AVATAR_TIMEOUT']) as response:
+            mimetype = response.headers.get_content_type()
+            if mimetype not in EXTENSIONS:
+                return None
+            return EXTENSIONS[mimetype], response.read()
+    except urllib.error.HTTPError as error:
+        if error.code == 404:
+            return None
+        raise
+
+
+def refresh(digest, size):
+    if not current_app.config['AVATAR_ORIGIN']:
+        return store(digest, size, 'svg', identicon(digest, size))
+    try:
+        picture = fetch(digest, size)
+    except (OSError, urllib.error.URLError):
+        current_app.logger.warning("Avatar origin unreachable for %s", digest)
+        return None
+    if picture is None:
+        return store(digest, size, 'svg', identicon(digest, size))
+    return store(digest, size, *picture)
+
+
+def avatar_response(digest, size, known=True):
+    """Serves the avatar of a hash. Unknown hashes get an identicon that is neither fetched nor stored."""
+    if not DIGEST.match(digest) or size not in SIZES:
+        abort(404)
+    if not known:
+        return current_app.response_class(identicon(digest, size), mimetype=MIMETYPES['svg'])
+
+    path = cached_path(digest, size)
+    if path is not None and time.time() - os.path.getmtime(path) < current_app.config['AVATAR_MAX_AGE']:
+        metrics.count('cache_requests_total', cache='avatar', result='hit')
+    else:
+        metrics.count('cache_requests_total', cache='avatar', result='miss')
+        # A stale copy is still better than nothing when the origin is down.
+        path = refresh(digest, size) or path
+    if path is None:
+        return current_app.response_class(identicon(digest, size), mimetype=MIMETYPES['svg'])
+
+    response = send_file(path, mimetype=MIMETYPES[path.rsplit('.', 1)[1]], conditional=True, etag=True,
+                         max_age=current_app.config['AVATAR_MAX_AGE'])
+    response.cache_control.public = True
+    return response
+
+
+def init_app(app):
+    # AVATAR_ORIGIN can point to a stand-in server, or be empty to only draw identicons.
+    app.config.setdefault('AVATAR_ORIGIN', os.environ.get("AVATAR_ORIGIN", "https://www.gravatar.com/avatar"))
+    app.config.setdefault('AVATAR_RATING', os.environ.get("AVATAR_RATING", "g"))
+    app.config.setdefault('AVATAR_TIMEOUT', float(os.environ.get("AVATAR_TIMEOUT", 2)))
+    app.config.setdefault('AVATAR_MAX_AGE', int(os.environ.get("AVATAR_MAX_AGE", 86400)))
+    app.config.setdefault('AVATAR_CACHE_DIR',
+                          os.environ.get("AVATAR_CACHE_DIR", os.path.join(app.instance_path, "avatars")))
+    os.makedirs(app.config['AVATAR_CACHE_DIR'], exist_ok=True)
@@ -0,0 +1,60 @@
+"""Stand-in for gravatar.com, to run the app and the benchmarks without the external service.
+
+Hashes starting with an even hex digit have a picture (a plain PNG coloured from the
+hash), the others get a 404 so the app falls back to its identicons.
+
+Usage: python benchmarks/avatar_origin.py [--port 8081] [--latency-ms 0]
+       AVATAR_ORIGIN=http://127.0.0.1:8081 flask --app main run
+"""
+import argparse
+import struct
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def png(size, rgb):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    row = b'\x00' + bytes(rgb) * size
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(row * size))
+            + chunk(b'IEND', b''))
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        digest = url.path.rstrip('/').rsplit('/', 1)[-1]
+        size = int(parse_qs(url.query).get('s', ['80'])[0])
+        if not digest or digest[0] not in '02468ace':
+            self.send_error(404)
+            return
+        body = png(size, bytes.fromhex(digest[:6].ljust(6, '0')))
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args()
+    Handler.latency = args.latency_ms / 1000
+    ThreadingHTTPServer(('127.0.0.1', args.port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
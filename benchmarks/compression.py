@@ -0,0 +1,64 @@
+"""Bytes on the wire and CPU cost per page for the HTML compression pipeline.
+
+Usage: python benchmarks/compression.py [--beers 20] [--reviews 400] [--iterations 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+
+from datagen import PASSWORD, generate, user_email  # noqa: E402
+from main import create_app, db  # noqa: E402
+
+BASE_URL = "https://localhost"
+MODES = [
+    ('raw', False, 'identity'),
+    ('collapsed', True, 'identity'),
+    ('gzip', True, 'gzip'),
+    ('br', True, 'br'),
+]
+
+
+def measure(client, path, encoding, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        response = client.get(path, base_url=BASE_URL, headers={'Accept-Encoding': encoding})
+    cpu = (time.process_time() - start) / iterations
+    return len(response.data), cpu
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--beers', type=int, default=20)
+    parser.add_argument('--reviews', type=int, default=400)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app({'WTF_CSRF_ENABLED': False})
+    with app.app_context():
+        generate(db, beers=args.beers, users=50, reviews=args.reviews, comments=args.reviews // 4, log=lambda _: None)
+
+    client = app.test_client()
+    client.post('/login', data={'email': user_email(0), 'password': PASSWORD}, base_url=BASE_URL)
+    pages = ['/', '/beers/note', '/beer/1', '/admin-edit-review-page', '/admin-delete-review-page']
+
+    print(f"{'page':28}" + ''.join(f"{name:>12}{'ms':>8}" for name, _, _ in MODES))
+    for path in pages:
+        client.get(path, base_url=BASE_URL)
+        line = f"{path:28}"
+        for name, collapse, encoding in MODES:
+            app.config['COLLAPSE_WHITESPACE'] = collapse
+            size, cpu = measure(client, path, encoding, args.iterations)
+            line += f"{size:>12}{cpu * 1000:>8.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,150 @@
+"""Seeded generator filling the User, Beer, Review and Comment tables.
+
+Beers come in several versions sharing a name, every user has the password
+"password" and the first user is an admin. The same seed and scale always give
+the same data.
+
+Usage: python benchmarks/datagen.py --database-url sqlite:///load.db \\
+           [--beers 5000] [--users 50000] [--reviews 1000000] [--comments 50000] [--seed 42]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import func, insert, select, update  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+PASSWORD = "password"
+CHUNK = 10000
+ATTRIBUTES = ['mousse', 'couleur', 'opacite', 'petillant', 'douceur', 'amertume', 'acidite', 'gushing',
+              'alcooleux', 'fruite', 'floral', 'houblonne', 'boise', 'torrefie', 'herbeux', 'cereales', 'epice']
+TYPES = ['Blonde', 'Blanche', 'Ambrée', 'Brune', 'IPA', 'Triple', 'Saison', 'Stout', 'Porter', 'Lambic']
+MALTS = ['Pils', 'Munich II', 'Vienna', 'Froment blanc', 'Cara 30', 'Chocolat', 'Avoine']
+HOPS = ['Tettnang', 'Goldings', 'Styrian Goldings', 'Saaz', 'Cascade', 'Citra', 'Mosaic']
+WORDS = ['houblonnée', 'fruitée', 'amère', 'ronde', 'sèche', 'légère', 'épicée', 'maltée', 'fraîche', 'longue',
+         'en bouche', 'belle mousse', 'robe dorée', 'notes de pain', 'finale', 'agrumes', 'caramel']
+
+
+def user_email(index):
+    return f"user{index}@example.com"
+
+
+def chunked(rows, size=CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def sentence(rng, n_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + '.'
+
+
+def generate(db, beers=5000, users=50000, reviews=1000000, comments=50000, max_versions=3, seed=42, log=print):
+    from main import User, Beer, Review, Comment, radar_payload
+
+    rng = random.Random(seed)
+    db.create_all()
+    if db.session.scalar(select(func.count(Beer.id))):
+        raise SystemExit("The database already contains beers, use an empty one.")
+
+    start = time.perf_counter()
+    password = generate_password_hash(PASSWORD, method='pbkdf2:sha256', salt_length=8)
+    for chunk in chunked({'email': user_email(i), 'password': password, 'name': f"Prénom{i}", 'surname': f"Nom{i}",
+                          'is_admin': i == 0} for i in range(users)):
+        db.session.execute(insert(User), chunk)
+    log(f"{users} users in {time.perf_counter() - start:.1f} s")
+
+    beer_rows = []
+    name_index = 0
+    while len(beer_rows) < beers:
+        n_versions = min(rng.randint(1, max_versions), beers - len(beer_rows))
+        beer_type = rng.choice(TYPES)
+        for version in range(1, n_versions + 1):
+            beer_rows.append({
+                'name': f"Bière {name_index}",
+                'type': beer_type,
+                'version': version,
+                'date': datetime.datetime(2018 + version, rng.randint(1, 12), 1),
+                'malt': ', '.join(rng.sample(MALTS, 3)),
+                'houblon': ', '.join(rng.sample(HOPS, 2)),
+                'description': f"<p>{sentence(rng, 60)}</p><p>{sentence(rng, 40)}</p>",
+                'score': 0,
+                **{attribute: 0 for attribute in ATTRIBUTES},
+            })
+        name_index += 1
+    for chunk in chunked(beer_rows):
+        db.session.execute(insert(Beer), chunk)
+    log(f"{beers} beers ({name_index} names) in {time.perf_counter() - start:.1f} s")
+
+    user_ids = db.session.scalars(select(User.id).order_by(User.id)).all()
+    beer_ids = db.session.scalars(select(Beer.id).order_by(Beer.id)).all()
+
+    # Each beer has its own profile, reviews scatter around it.
+    profiles = {beer_id: [rng.randint(0, 10) for _ in range(len(ATTRIBUTES) + 1)] for beer_id in beer_ids}
+
+    def review_rows():
+        for _ in range(reviews):
+            beer_id = rng.choice(beer_ids)
+            values = [min(10, max(0, value + rng.randint(-2, 2))) for value in profiles[beer_id]]
+            yield {'beer_id': beer_id, 'author_id': rng.choice(user_ids), 'score': values[-1],
+                   **dict(zip(ATTRIBUTES, values))}
+
+    for i, chunk in enumerate(chunked(review_rows())):
+        db.session.execute(insert(Review), chunk)
+        if i % 10 == 9:
+            log(f"  {(i + 1) * CHUNK} reviews")
+    log(f"{reviews} reviews in {time.perf_counter() - start:.1f} s")
+
+    for chunk in chunked({'beer_id': rng.choice(beer_ids), 'author_id': rng.choice(user_ids),
+                          'text': sentence(rng, rng.randint(5, 30))} for _ in range(comments)):
+        db.session.execute(insert(Comment), chunk)
+    log(f"{comments} comments in {time.perf_counter() - start:.1f} s")
+
+    # Beer aggregates from one GROUP BY over the reviews, as recalculate_beer would leave them.
+    columns = [func.avg(getattr(Review, attribute), type_=db.Float) for attribute in ATTRIBUTES + ['score']]
+    aggregates = db.session.execute(select(Review.beer_id, *columns).group_by(Review.beer_id)).all()
+    identities = dict(zip(beer_ids, beer_rows))
+    rows = []
+    for row in aggregates:
+        fields = {**identities[row[0]], **dict(zip(ATTRIBUTES, row[1:-1])), 'score': round(row[-1], 1)}
+        rows.append({'id': row[0], 'radar': radar_payload(fields),
+                     **{attribute: fields[attribute] for attribute in ATTRIBUTES + ['score']}})
+    for chunk in chunked(rows):
+        db.session.execute(update(Beer), chunk)
+    db.session.commit()
+    log(f"aggregates in {time.perf_counter() - start:.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--beers', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--reviews', type=int, default=1000000)
+    parser.add_argument('--comments', type=int, default=50000)
+    parser.add_argument('--max-versions', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    from main import create_app, db
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': args.database_url})
+    with app.app_context():
+        generate(db, beers=args.beers, users=args.users, reviews=args.reviews, comments=args.comments,
+                 max_versions=args.max_versions, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
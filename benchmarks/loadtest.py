@@ -0,0 +1,308 @@
+"""Scripted load test of the real routes, in process or against a local gunicorn.
+
+Each virtual user logs in, then browses /beers/<sort> and /beer/<id> and fills
+in review forms, CSRF tokens included. Latencies go to a JSON file with the git
+commit, so two runs can be compared.
+
+The database must have been filled by datagen.py first:
+
+    python benchmarks/datagen.py --database-url sqlite:///$PWD/load.db
+    python benchmarks/loadtest.py --database-url sqlite:///$PWD/load.db --target client --output client.json
+    python benchmarks/loadtest.py --database-url sqlite:///$PWD/load.db --target gunicorn --concurrency 8 \\
+        --output gunicorn.json
+    python benchmarks/loadtest.py --compare before.json after.json
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from datagen import PASSWORD, user_email  # noqa: E402
+
+BASE_URL = "https://localhost"
+SORTS = ['note', 'date', 'mousse', 'couleur', 'opacité', 'pétillant', 'douceur', 'amertume', 'acidité', 'gushing',
+         'alcooleux', 'fruité', 'floral', 'houblonné', 'boisé', 'torréfié', 'herbeux', 'céréales', 'épicé']
+MIX = [('beers', 40), ('beer', 40), ('review', 15), ('login', 5)]
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data, base_url=BASE_URL)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HttpClient:
+    """Keep-alive connection to gunicorn carrying its own cookies, as a browser behind the TLS proxy would."""
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        headers = {'X-Forwarded-Proto': 'https', 'Host': 'localhost'}
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{name}={value}" for name, value in self.cookies.items())
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.connection.request(method, quote(path), body=body, headers=headers)
+            response = self.connection.getresponse()
+            text = response.read().decode()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            raise
+        for header in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name] = value
+        return response.status, text
+
+
+def csrf_token(html):
+    match = CSRF_PATTERN.search(html)
+    return match.group(1) if match else ''
+
+
+class VirtualUser:
+    def __init__(self, client, rng, n_users, beer_ids, record):
+        self.client = client
+        self.rng = rng
+        self.n_users = n_users
+        self.beer_ids = beer_ids
+        self.record = record
+
+    def timed(self, name, method, path, data=None, expected=(200, 302)):
+        start = time.perf_counter()
+        try:
+            status, html = self.client.request(method, path, data)
+        except Exception:
+            self.record(name, time.perf_counter() - start, False)
+            return ''
+        self.record(name, time.perf_counter() - start, status in expected)
+        return html
+
+    def login(self):
+        html = self.timed('login_form', 'GET', '/login')
+        self.timed('login', 'POST', '/login', {
+            'csrf_token': csrf_token(html), 'email': user_email(self.rng.randrange(self.n_users)),
+            'password': PASSWORD, 'submit': "S'identifier"}, expected=(302,))
+
+    def beers(self):
+        self.timed('beers', 'GET', f"/beers/{self.rng.choice(SORTS)}")
+
+    def beer(self):
+        self.timed('beer', 'GET', f"/beer/{self.rng.choice(self.beer_ids)}")
+
+    def review(self):
+        values = '/'.join(str(self.rng.randint(0, 10)) for _ in range(18))
+        path = f"/review/{self.rng.choice(self.beer_ids)}/{values}/None"
+        html = self.timed('review_form', 'GET', path)
+        self.timed('review', 'POST', path, {'csrf_token': csrf_token(html), 'submit': 'OK'}, expected=(302,))
+
+    def run(self, deadline):
+        self.login()
+        names = [name for name, _ in MIX]
+        weights = [weight for _, weight in MIX]
+        while time.perf_counter() < deadline:
+            getattr(self, self.rng.choices(names, weights)[0])()
+
+
+def load_fixture(database_url):
+    from sqlalchemy import create_engine, func, select
+    from main import User, Beer
+
+    engine = create_engine(database_url)
+    with engine.connect() as connection:
+        n_users = connection.scalar(select(func.count(User.id)))
+        beer_ids = connection.scalars(select(Beer.id)).all()
+    engine.dispose()
+    if not n_users or not beer_ids:
+        raise SystemExit("Empty database, run benchmarks/datagen.py first.")
+    return n_users, beer_ids
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(database_url, workers):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=database_url, PORT=str(port), WEB_CONCURRENCY=str(workers))
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind',
+                                f"127.0.0.1:{port}"], env=env, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit("gunicorn did not start.")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies, errors, elapsed):
+    scenarios = {}
+    for name, values in sorted(latencies.items()):
+        scenarios[name] = {
+            'requests': len(values),
+            'errors': errors.get(name, 0),
+            'throughput': round(len(values) / elapsed, 2),
+            'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+        }
+    everything = [value for values in latencies.values() for value in values]
+    scenarios['total'] = {
+        'requests': len(everything),
+        'errors': sum(errors.values()),
+        'throughput': round(len(everything) / elapsed, 2),
+        'p50_ms': round(percentile(everything, 0.5) * 1000, 2) if everything else None,
+        'p99_ms': round(percentile(everything, 0.99) * 1000, 2) if everything else None,
+    }
+    return scenarios
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def drive(users, seconds):
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user.run, args=(start + seconds,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def run(args):
+    n_users, beer_ids = load_fixture(args.database_url)
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def record(name, seconds, ok):
+        with lock:
+            latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                errors[name] = errors.get(name, 0) + 1
+
+    process = None
+    if args.target == 'gunicorn':
+        process, port = start_gunicorn(args.database_url, args.workers)
+        make_client = lambda: HttpClient(port)  # noqa: E731
+    else:
+        os.environ['DATABASE_URL'] = args.database_url
+        from main import create_app
+        app = create_app()
+        make_client = lambda: TestClient(app)  # noqa: E731
+
+    try:
+        users = [VirtualUser(make_client(), random.Random(args.seed + i), n_users, beer_ids, record)
+                 for i in range(args.concurrency)]
+        if args.warmup:
+            drive(users, args.warmup)
+            latencies.clear()
+            errors.clear()
+        elapsed = drive(users, args.duration)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    result = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'target': args.target,
+        'concurrency': args.concurrency,
+        'workers': args.workers if args.target == 'gunicorn' else None,
+        'duration': round(elapsed, 2),
+        'users': n_users,
+        'beers': len(beer_ids),
+        'scenarios': summarize(latencies, errors, elapsed),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print_result(result)
+
+
+def print_result(result):
+    print(f"{result['target']} @ {(result['commit'] or '?')[:10]}, {result['concurrency']} users, "
+          f"{result['duration']} s")
+    print(f"{'scenario':14}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stats in result['scenarios'].items():
+        print(f"{name:14}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>10}"
+              f"{stats['p50_ms']:>10}{stats['p99_ms']:>10}")
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{(before['commit'] or '?')[:10]} -> {(after['commit'] or '?')[:10]}")
+    print(f"{'scenario':14}{'req/s':>20}{'p50 ms':>20}{'p99 ms':>20}")
+    for name, stats in after['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if old is None:
+            continue
+        line = f"{name:14}"
+        for key in ('throughput', 'p50_ms', 'p99_ms'):
+            change = (stats[key] - old[key]) / old[key] * 100 if old[key] else 0
+            line += f"{old[key]:>8} {stats[key]:>8} {change:+.0f}%".rjust(20)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-url')
+    parser.add_argument('--target', choices=['client', 'gunicorn'], default='client')
+    parser.add_argument('--concurrency', type=int, default=1, help="virtual users, one thread each")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=0, help="seconds of untimed traffic before the run")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='loadtest.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.database_url:
+        run(args)
+    else:
+        parser.error("--database-url is required")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Peak memory allocated, SQL statements and time per request for the listing pages.
+
+Usage: python benchmarks/memory.py [--beers 10000] [--reviews 20000] [--iterations 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/benchmark.db"
+
+from sqlalchemy import event  # noqa: E402
+
+from datagen import PASSWORD, generate, user_email  # noqa: E402
+from main import create_app, db  # noqa: E402
+
+BASE_URL = "https://localhost"
+PAGES = [
+    '/beers/note',
+    '/beers/date',
+    '/beer/1',
+    '/admin-add-beer-page',
+    '/admin-edit-beer-page',
+    '/admin-delete-beer-page',
+    '/admin-qr-page',
+    '/admin-edit-review-page',
+]
+
+
+def measure(client, path, iterations, statements):
+    peaks = []
+    counts = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        statements.clear()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        response = client.get(path, base_url=BASE_URL)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        counts.append(len(statements))
+        assert response.status_code == 200, (path, response.status_code)
+    elapsed = (time.perf_counter() - start) / iterations
+    return max(peaks), max(counts), elapsed
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--beers', type=int, default=10000)
+    parser.add_argument('--reviews', type=int, default=20000)
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app({'WTF_CSRF_ENABLED': False})
+    with app.app_context():
+        generate(db, beers=args.beers, users=200, reviews=args.reviews, comments=args.reviews // 10,
+                 log=lambda _: None)
+        engine = db.engine
+
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    client = app.test_client()
+    client.post('/login', data={'email': user_email(0), 'password': PASSWORD}, base_url=BASE_URL)
+    for path in PAGES:
+        client.get(path, base_url=BASE_URL)
+
+    tracemalloc.start()
+    print(f"{'page':28}{'peak MiB':>10}{'queries':>10}{'ms':>10}")
+    for path in PAGES:
+        peak, queries, elapsed = measure(client, path, args.iterations, statements)
+        print(f"{path:28}{peak / 2 ** 20:>10.2f}{queries:>10}{elapsed * 1000:>10.1f}")
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main_benchmark()
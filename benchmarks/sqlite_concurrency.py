@@ -0,0 +1,109 @@
+"""Several processes submitting reviews to the same SQLite file at the same time.
+
+Each process plays one user and posts reviews through the real /review route,
+once with the tuned SQLite mode (WAL, busy timeout, serialized writes) and once
+with stock settings. Reports committed reviews, failures and throughput.
+
+Usage: python benchmarks/sqlite_concurrency.py [--processes 8] [--reviews 50]
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+BASE_URL = "https://localhost"
+N_BEERS = 10
+
+
+def make_app(database_url, tuned):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['SQLITE_TUNED'] = '1' if tuned else '0'
+    from main import create_app
+    return create_app({'WTF_CSRF_ENABLED': False})
+
+
+def create_database(database_url, tuned, n_users):
+    from main import db, User, Beer
+
+    app = make_app(database_url, tuned)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([User(email=f"user{i}@example.com", password="x", name=f"User{i}", surname="Test",
+                                 is_admin=False) for i in range(n_users)])
+        db.session.add_all([Beer(name=f"Beer {i}", type="Blonde", version=1, date=datetime.datetime(2022, 1, 1),
+                                 malt="", houblon="", description="", score=0) for i in range(N_BEERS)])
+        db.session.commit()
+        user_ids = [user.id for user in User.query.all()]
+    return user_ids
+
+
+def submit_reviews(database_url, tuned, user_id, n_reviews, start_event, results):
+    app = make_app(database_url, tuned)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    start_event.wait()
+    ok = failed = 0
+    for i in range(n_reviews):
+        values = '/'.join(str((user_id + i + k) % 11) for k in range(17))
+        url = f"/review/{i % N_BEERS + 1}/{values}/{(user_id + i) % 11}/None"
+        try:
+            response = client.post(url, data={'submit': 'OK'}, base_url=BASE_URL)
+            if response.status_code == 302:
+                ok += 1
+            else:
+                failed += 1
+        except Exception:
+            failed += 1
+    results.put((ok, failed))
+
+
+def run(processes, n_reviews, tuned):
+    database_url = f"sqlite:///{tempfile.mkdtemp()}/concurrency.db"
+    user_ids = create_database(database_url, tuned, processes)
+
+    context = multiprocessing.get_context('spawn')
+    start_event = context.Event()
+    results = context.Queue()
+    workers = [context.Process(target=submit_reviews,
+                               args=(database_url, tuned, user_id, n_reviews, start_event, results))
+               for user_id in user_ids]
+    for worker in workers:
+        worker.start()
+    time.sleep(2)
+
+    start = time.perf_counter()
+    start_event.set()
+    totals = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+
+    ok = sum(item[0] for item in totals)
+    failed = sum(item[1] for item in totals)
+    label = 'tuned' if tuned else 'stock'
+    print(f"{label:6} {processes} processes: {ok} reviews committed, {failed} failed, "
+          f"{elapsed:.2f} s, {ok / elapsed:.1f} reviews/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--reviews', type=int, default=50, help="reviews submitted by each process")
+    args = parser.parse_args()
+    for tuned in (False, True):
+        run(args.processes, args.reviews, tuned)
+
+
+if __name__ == "__main__":
+    main()
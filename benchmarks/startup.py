@@ -0,0 +1,105 @@
+"""Time to first response of a cold gunicorn server.
+
+Starts gunicorn with the repo's gunicorn.conf.py, polls until the first page is
+served and reports the elapsed time, with templates compiled lazily in the
+workers and with templates compiled once in the preloading master.
+
+Usage: python benchmarks/startup.py [--runs 3] [--warm-cache]
+"""
+import argparse
+import datetime
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = ['/', '/beers/note', '/beer/1', '/login']
+
+
+def create_database():
+    sys.path.insert(0, ROOT)
+    from main import create_app, db, Beer
+
+    url = f"sqlite:///{tempfile.mkdtemp()}/startup.db"
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'SECRET_KEY': 'benchmark'})
+    with app.app_context():
+        db.create_all()
+        db.session.add(Beer(name="Blonde", type="Blonde", version=1, date=datetime.datetime(2022, 6, 1), malt="Pils",
+                            houblon="Saaz", description="<p>Blonde</p>", score=0))
+        db.session.commit()
+    return url
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def first_response(url, timeout):
+    # Talisman redirects plain HTTP, the forwarded header makes the request look like HTTPS.
+    request = urllib.request.Request(url, headers={'X-Forwarded-Proto': 'https'})
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.01)
+    raise TimeoutError(url)
+
+
+def run(database_url, preload, warm_cache, workers, timeout):
+    port = free_port()
+    env = dict(os.environ,
+               SECRET_KEY='benchmark',
+               PORT=str(port),
+               WEB_CONCURRENCY=str(workers),
+               PRELOAD_TEMPLATES='1' if preload else '0',
+               DATABASE_URL=database_url)
+    if not warm_cache:
+        env['JINJA_CACHE_DIR'] = tempfile.mkdtemp()
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py']
+    start = time.monotonic()
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first_response(f"http://127.0.0.1:{port}{PAGES[0]}", timeout)
+        first = time.monotonic() - start
+        for path in PAGES[1:]:
+            first_response(f"http://127.0.0.1:{port}{path}", timeout)
+        return first, time.monotonic() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--warm-cache', action='store_true',
+                        help="reuse the Jinja bytecode cache of the instance folder instead of a fresh one")
+    args = parser.parse_args()
+
+    database_url = create_database()
+    for preload in (False, True):
+        firsts, alls = [], []
+        for _ in range(args.runs):
+            first, every = run(database_url, preload, args.warm_cache, args.workers, args.timeout)
+            firsts.append(first)
+            alls.append(every)
+        label = 'preloaded templates' if preload else 'lazy templates'
+        print(f"{label:20} first response {min(firsts) * 1000:6.0f} ms, "
+              f"all of {', '.join(PAGES)} {min(alls) * 1000:6.0f} ms (best of {args.runs})")
+
+
+if __name__ == "__main__":
+    main()
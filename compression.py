@@ -0,0 +1,177 @@
+import re
+import zlib
+
+from werkzeug.wrappers import Request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MIMETYPES = [
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/xml',
+    'application/json',
+    'application/javascript',
+    'image/svg+xml',
+]
+
+# Blocks whose whitespace is significant and must be sent untouched.
+PROTECTED_BLOCK = re.compile(r'(<(pre|textarea)\b.*?</\2>)', re.IGNORECASE | re.DOTALL)
+LEADING_WHITESPACE = re.compile(r'^[ \t]+', re.MULTILINE)
+TRAILING_WHITESPACE = re.compile(r'[ \t]+$', re.MULTILINE)
+BLANK_LINES = re.compile(r'\n{2,}')
+
+
+def collapse_whitespace(html):
+    # Line breaks are kept: inline scripts rely on them in place of semicolons.
+    parts = PROTECTED_BLOCK.split(html)
+    result = []
+    i = 0
+    while i < len(parts):
+        text = parts[i]
+        text = LEADING_WHITESPACE.sub('', text)
+        text = TRAILING_WHITESPACE.sub('', text)
+        text = BLANK_LINES.sub('\n', text)
+        result.append(text)
+        if i + 1 < len(parts):
+            result.append(parts[i + 1])
+        i += 3
+    return ''.join(result)
+
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, chunk):
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def process(self, chunk):
+        return self.compressor.process(chunk) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class Compress:
+    """WSGI middleware compressing dynamic responses on the fly.
+
+    Only responses of a compressible content type, at least min_size bytes long and
+    not already encoded are compressed. The body is encoded chunk by chunk so
+    streamed responses keep streaming.
+    """
+
+    def __init__(self, app, mimetypes=None, min_size=500, gzip_level=6, brotli_level=4):
+        self.app = app
+        self.mimetypes = set(mimetypes or DEFAULT_MIMETYPES)
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_level = brotli_level
+
+    def choose_encoder(self, environ):
+        accept = Request(environ).accept_encodings
+        if brotli is not None and accept['br']:
+            return BrotliEncoder(self.brotli_level)
+        if accept['gzip']:
+            return GzipEncoder(self.gzip_level)
+        return None
+
+    def mimetype(self, headers):
+        for name, value in headers:
+            if name.lower() == 'content-type':
+                return value.split(';')[0].strip()
+        return None
+
+    def should_compress(self, status, headers):
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        for name, value in headers:
+            if name.lower() == 'content-encoding':
+                return False
+            if name.lower() == 'content-length' and int(value) < self.min_size:
+                return False
+        return True
+
+    def __call__(self, environ, start_response):
+        # A HEAD response has no body to encode, the encoder would still emit its header.
+        encoder = self.choose_encoder(environ) if environ.get('REQUEST_METHOD') != 'HEAD' else None
+        if encoder is None:
+            return self.app(environ, start_response)
+
+        state = {'encoder': None}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            if self.mimetype(headers) in self.mimetypes:
+                headers = add_vary(headers, 'Accept-Encoding')
+                if self.should_compress(status, headers):
+                    state['encoder'] = encoder
+                    headers = [(name, weak_etag(value) if name.lower() == 'etag' else value)
+                               for name, value in headers if name.lower() != 'content-length']
+                    headers.append(('Content-Encoding', encoder.name))
+            return start_response(status, headers, exc_info)
+
+        body = self.app(environ, compressing_start_response)
+        return self.encode(body, state)
+
+    def encode(self, body, state):
+        try:
+            for chunk in body:
+                encoder = state['encoder']
+                if encoder is None:
+                    yield chunk
+                elif chunk:
+                    data = encoder.process(chunk)
+                    if data:
+                        yield data
+            if state['encoder'] is not None:
+                yield state['encoder'].finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+def add_vary(headers, field):
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if field.lower() not in value.lower():
+                headers[i] = (name, f"{value}, {field}")
+            return headers
+    return headers + [('Vary', field)]
+
+
+def weak_etag(value):
+    return value if value.startswith('W/') else f"W/{value}"
+
+
+def init_app(app):
+    app.jinja_env.trim_blocks = True
+    app.jinja_env.lstrip_blocks = True
+
+    @app.after_request
+    def minify_html(response):
+        if app.config.get('COLLAPSE_WHITESPACE', True) and response.mimetype == 'text/html' \
+                and response.status_code != 304 and not response.direct_passthrough and not response.is_streamed:
+            response.set_data(collapse_whitespace(response.get_data(as_text=True)))
+        return response
+
+    app.wsgi_app = Compress(app.wsgi_app,
+                            mimetypes=app.config.get('COMPRESS_MIMETYPES'),
+                            min_size=app.config.get('COMPRESS_MIN_SIZE', 500),
+                            gzip_level=app.config.get('COMPRESS_GZIP_LEVEL', 6),
+                            brotli_level=app.config.get('COMPRESS_BROTLI_LEVEL', 4))
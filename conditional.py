@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+
+from flask import current_app, request, session
+from flask_login import current_user
+
+
+def template_digest(app):
+    # A deploy that changes the templates, or the fingerprinted assets they link to, must not be
+    # answered with 304.
+    digest = hashlib.sha1()
+    for folder, _, files in sorted(os.walk(os.path.join(app.root_path, app.template_folder))):
+        for name in sorted(files):
+            with open(os.path.join(folder, name), 'rb') as f:
+                digest.update(f.read())
+    digest.update(json.dumps(app.config.get('ASSET_MANIFEST', {}), sort_keys=True).encode())
+    return digest.hexdigest()[:12]
+
+
+def variant():
+    # Pages show the navbar of the logged-in user, so each user has their own copy.
+    if not current_user.is_authenticated:
+        return 'anonymous'
+    return f"user-{current_user.id}-{int(bool(current_user.is_admin))}"
+
+
+def make_etag(*parts):
+    key = ':'.join(str(part) for part in (current_app.config['TEMPLATES_DIGEST'], variant()) + parts)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    if session.get('_flashes'):
+        return False
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    # Last-Modified does not tell variants apart, only anonymous copies are validated by date.
+    if request.if_modified_since and last_modified and not current_user.is_authenticated:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def check(etag, last_modified):
+    """Returns a 304 response when the client copy is current, None when the page must be rendered."""
+    if not_modified(etag, last_modified):
+        return validators(current_app.response_class(status=304), etag, last_modified)
+    return None
+
+
+def init_app(app):
+    app.config['TEMPLATES_DIGEST'] = template_digest(app)
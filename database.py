@@ -0,0 +1,315 @@
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import and_, delete, event, inspect, or_, select, text
+from sqlalchemy.schema import AddConstraint, CreateColumn, CreateIndex, CreateTable
+from sqlalchemy.sql import Select
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+REPLICA = 'replica'
+
+# Seconds during which a user who just wrote keeps reading from the primary.
+PRIMARY_PIN_SECONDS = 10
+
+pool_stats = {}
+write_locks = {}
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def engine_options(url):
+    options = {'pool_pre_ping': os.environ.get("DB_POOL_PRE_PING", "1") == "1"}
+    if url.startswith('sqlite'):
+        return options
+
+    options.update(
+        pool_size=env_int("DB_POOL_SIZE", 5),
+        max_overflow=env_int("DB_MAX_OVERFLOW", 10),
+        pool_timeout=env_int("DB_POOL_TIMEOUT", 30),
+        pool_recycle=env_int("DB_POOL_RECYCLE", 1800),
+    )
+    if url.startswith('postgres'):
+        options['connect_args'] = {'options': f"-c statement_timeout={env_int('DB_STATEMENT_TIMEOUT_MS', 30000)}"}
+    return options
+
+
+def configure(app):
+    url = os.environ.get("DATABASE_URL", "sqlite:///brasserie-piron.db")
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(url)
+
+    # Single node deployments on SQLite: WAL, busy timeout and serialized writes.
+    app.config['SQLITE_TUNED'] = os.environ.get("SQLITE_TUNED", "1") == "1"
+
+    replica_url = os.environ.get("DATABASE_REPLICA_URL")
+    if replica_url:
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA: {'url': replica_url, **engine_options(replica_url)}}
+
+
+def sqlite_pragmas():
+    return {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': env_int("SQLITE_BUSY_TIMEOUT_MS", 10000),
+        'mmap_size': env_int("SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+    }
+
+
+def tune_sqlite(engine):
+    pragmas = sqlite_pragmas()
+    if engine.url.database and engine.url.database != ':memory:':
+        write_locks[engine] = WriteLock(f"{engine.url.database}-write.lock")
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def enforce_foreign_keys(engine):
+    # SQLite ignores foreign keys, and so ON DELETE CASCADE, unless enabled on each connection.
+    @event.listens_for(engine, "connect")
+    def set_foreign_keys(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+class WriteLock:
+    """Exclusive lock shared by every process writing to the same SQLite file.
+
+    Concurrent writers queue on the lock instead of racing for the database lock,
+    so a burst of reviews is committed one after the other rather than failing
+    with "database is locked".
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.fd = None
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.thread_lock.release()
+
+
+def acquire_write_lock(db_session):
+    if 'write_lock' in db_session.info:
+        return
+    lock = write_locks.get(db_session.get_bind())
+    if lock is not None:
+        lock.acquire()
+        db_session.info['write_lock'] = lock
+
+
+def replica_reads(f):
+    # Marks a view whose GET requests may be answered from the read replica.
+    f.replica_reads = True
+    return f
+
+
+class RoutingSession(Session):
+    """Sends the SELECTs of replica_reads views to the replica bind.
+
+    Flushes, DML and every query of a session that already wrote go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.reads_from_replica(clause):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def reads_from_replica(self, clause):
+        return (has_request_context()
+                and g.get('use_replica', False)
+                and not self._flushing
+                and not self.info.get('wrote', False)
+                and isinstance(clause, Select)
+                and REPLICA in self._db.engines)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def remember_write(db_session, flush_context):
+    db_session.info['wrote'] = True
+    if has_request_context():
+        g.db_wrote = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_write(db_session):
+    db_session.info.pop('wrote', None)
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def serialize_flush(db_session, flush_context, instances):
+    acquire_write_lock(db_session)
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def serialize_bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        acquire_write_lock(orm_execute_state.session)
+        remember_write(orm_execute_state.session, None)
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def release_write_lock(db_session, transaction):
+    if transaction.parent is None and 'write_lock' in db_session.info:
+        db_session.info.pop('write_lock').release()
+
+
+def track_pool(name, engine):
+    stats = pool_stats.setdefault(name, {'connects': 0, 'checkouts': 0, 'checked_out': 0, 'checkout_seconds': 0.0})
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        stats['connects'] += 1
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats['checkouts'] += 1
+        stats['checked_out'] += 1
+        connection_record.info['checkout_time'] = time.perf_counter()
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        started = connection_record.info.pop('checkout_time', None)
+        if started is not None:
+            stats['checked_out'] -= 1
+            stats['checkout_seconds'] += time.perf_counter() - started
+
+
+def pool_status(db):
+    status = {}
+    for bind_key, engine in db.engines.items():
+        name = bind_key or 'primary'
+        status[name] = {**pool_stats.get(name, {}), 'pool': engine.pool.status()}
+    return status
+
+
+def init_app(app, db):
+    with app.app_context():
+        for bind_key, engine in db.engines.items():
+            track_pool(bind_key or 'primary', engine)
+            if engine.dialect.name == 'sqlite':
+                enforce_foreign_keys(engine)
+            if engine.dialect.name == 'sqlite' and app.config['SQLITE_TUNED']:
+                tune_sqlite(engine)
+
+    @app.before_request
+    def route_reads():
+        view = app.view_functions.get(request.endpoint)
+        pinned = session.get('primary_until', 0) > time.time()
+        g.use_replica = (request.method in ('GET', 'HEAD') and not pinned
+                         and getattr(view, 'replica_reads', False))
+
+    @app.after_request
+    def pin_writer_to_primary(response):
+        # Read-your-writes: the replica may lag behind the commit that was just made.
+        if g.get('db_wrote'):
+            session['primary_until'] = time.time() + PRIMARY_PIN_SECONDS
+        return response
+
+
+def upgrade_schema(db, log=print):
+    """Brings an existing database up to the models.
+
+    create_all() only creates missing tables: this adds the columns missing from existing
+    tables and recreates the foreign keys whose ON DELETE rule changed. Returns the orphaned
+    rows deleted on the way, by table name, so the caller can fix what was derived from them.
+    """
+    deleted = {}
+    db.create_all()
+    engine = db.engine
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        quote = engine.dialect.identifier_preparer.quote
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {column_ddl}"))
+                    log(f"Added {table.name}.{column.name}")
+
+        for table in db.metadata.sorted_tables:
+            stale = stale_foreign_keys(inspector, table)
+            if not stale:
+                continue
+            orphans = delete_orphans(connection, table, log)
+            if orphans:
+                deleted[table.name] = orphans
+            if engine.dialect.name == 'sqlite':
+                rebuild_table(connection, table)
+            else:
+                for foreign_key in stale:
+                    name = quote(foreign_key['name'])
+                    connection.execute(text(f"ALTER TABLE {quote(table.name)} DROP CONSTRAINT {name}"))
+                for constraint in {foreign_key.constraint for foreign_key in table.foreign_keys}:
+                    connection.execute(AddConstraint(constraint))
+            log(f"Recreated the foreign keys of {table.name}")
+    return deleted
+
+
+def stale_foreign_keys(inspector, table):
+    wanted = {(foreign_key.parent.name, foreign_key.column.table.name): foreign_key.ondelete
+              for foreign_key in table.foreign_keys}
+    stale = []
+    for foreign_key in inspector.get_foreign_keys(table.name):
+        key = (foreign_key['constrained_columns'][0], foreign_key['referred_table'])
+        if key in wanted and (foreign_key['options'].get('ondelete') or '').upper() != (wanted[key] or '').upper():
+            stale.append(foreign_key)
+    return stale
+
+
+def delete_orphans(connection, table, log):
+    """Deletes the rows referring to a row that no longer exists, they would break the new constraint.
+
+    A NULL reference is valid and kept. Returns the deleted rows.
+    """
+    references = [and_(foreign_key.parent.is_not(None), foreign_key.parent.not_in(select(foreign_key.column)))
+                  for foreign_key in table.foreign_keys if foreign_key.ondelete == 'CASCADE']
+    if not references:
+        return []
+    dangling = or_(*references)
+    orphans = [row._asdict() for row in connection.execute(select(table).where(dangling))]
+    if orphans:
+        connection.execute(delete(table).where(dangling))
+        log(f"Deleted {len(orphans)} orphaned rows from {table.name}")
+    return orphans
+
+
+def rebuild_table(connection, table):
+    # SQLite cannot alter a constraint, the table is copied into a new one. Only used for
+    # tables no other table refers to.
+    old_name = f"_{table.name}_old"
+    quote = connection.dialect.identifier_preparer.quote
+    existing = [column['name'] for column in inspect(connection).get_columns(table.name)]
+    columns = ', '.join(quote(name) for name in existing)
+    connection.execute(text(f"ALTER TABLE {quote(table.name)} RENAME TO {quote(old_name)}"))
+    connection.execute(CreateTable(table))
+    connection.execute(text(f"INSERT INTO {quote(table.name)} ({columns}) SELECT {columns} FROM {quote(old_name)}"))
+    connection.execute(text(f"DROP TABLE {quote(old_name)}"))
+    for index in table.indexes:
+        connection.execute(CreateIndex(index))
@@ -68,3 +68,8 @@ class ReviewForm(FlaskForm):
 class CommentForm(FlaskForm):
     comment_text = CKEditorField("Commentaire", validators=[DataRequired()])
     submit = SubmitField("OK")
+
+
+class SelectionForm(FlaskForm):
+    # Only carries the CSRF token, the selected ids are the "ids" checkboxes of the admin tables.
+    pass
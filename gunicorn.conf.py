@@ -0,0 +1,34 @@
+import glob
+import os
+
+# The app is built once in the master and forked into the workers, templates
+# included. Database connections are disposed in each child by create_app().
+os.environ.setdefault("PRELOAD_TEMPLATES", "1")
+os.environ.setdefault("METRICS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "metrics"))
+# Each worker runs the queued jobs in a thread: what they write lands on the disk this
+# instance serves from. Set to 0 when a `flask worker` shares the disk instead.
+os.environ.setdefault("JOBS_IN_PROCESS", "1")
+
+wsgi_app = "main:create_app()"
+preload_app = True
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+
+def on_starting(server):
+    # Metrics files of the workers of a previous run would be summed with the new ones.
+    for path in glob.glob(os.path.join(os.environ["METRICS_DIR"], "metrics-*.json")):
+        os.remove(path)
+
+
+def post_worker_init(worker):
+    if os.environ["JOBS_IN_PROCESS"] == "1":
+        import jobs
+
+        worker.stop_jobs = jobs.start_in_process(worker.wsgi)
+
+
+def worker_exit(server, worker):
+    # The job in progress is finished, the next ones are left to the other workers.
+    if hasattr(worker, 'stop_jobs'):
+        worker.stop_jobs(timeout=worker.cfg.graceful_timeout)
@@ -0,0 +1,62 @@
+import os
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if not has_request_context() or g.get('sql_stats') is None:
+        return
+
+    stats = g.sql_stats
+    stats.count += 1
+    stats.seconds += elapsed
+    stats.statements[statement] += 1
+
+    if elapsed * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        current_app.logger.warning("Slow query (%.1f ms) in %s: %s", elapsed * 1000, request.endpoint, statement)
+
+
+def init_app(app):
+    app.config.setdefault('SLOW_QUERY_MS', float(os.environ.get("SLOW_QUERY_MS", 100)))
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', int(os.environ.get("N_PLUS_ONE_THRESHOLD", 10)))
+    app.config.setdefault('SERVER_TIMING', os.environ.get("SERVER_TIMING", "1") == "1")
+
+    @app.before_request
+    def start_request_stats():
+        g.request_start = time.perf_counter()
+        g.sql_stats = QueryStats()
+
+    @app.after_request
+    def report_request_stats(response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+
+        threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        for statement, count in stats.statements.items():
+            if count > threshold:
+                app.logger.warning("Possible N+1 in %s: statement run %d times: %s", request.endpoint, count, statement)
+
+        if app.config['SERVER_TIMING']:
+            total = (time.perf_counter() - g.request_start) * 1000
+            response.headers.add('Server-Timing', f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries"')
+            response.headers.add('Server-Timing', f'app;dur={total:.1f}')
+        return response
@@ -0,0 +1,244 @@
+import datetime
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+import click
+from flask import current_app
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+import metrics
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+# A retry found another pending job with the same deduplication key, which will do the work.
+SUPERSEDED = 'superseded'
+STATUSES = [PENDING, RUNNING, DONE, FAILED, SUPERSEDED]
+
+MAX_BACKOFF = 3600
+
+tasks = {}
+# Tasks the worker queues by itself, every so many seconds: {name: seconds}.
+periodic = {}
+
+
+def task(name, priority=0, max_attempts=5, every=None):
+    """Registers f as the task run by the jobs called name. Higher priorities run first.
+
+    With every, the worker also runs it every so many seconds.
+    """
+    def decorator(f):
+        tasks[name] = (f, priority, max_attempts)
+        if every is not None:
+            periodic[name] = every
+        return f
+
+    return decorator
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def enqueue(name, dedup_key=None, priority=None, delay=0, **kwargs):
+    """Queues tasks[name](**kwargs) in the current transaction, the caller commits.
+
+    While a job with the same dedup_key is pending, nothing is queued. With JOBS_EAGER
+    the task runs right away instead.
+    """
+    db, Job = current_app.extensions['jobs']
+    function, default_priority, max_attempts = tasks[name]
+    if current_app.config['JOBS_EAGER']:
+        function(**kwargs)
+        return None
+
+    if dedup_key is not None:
+        pending = select(Job.id).where(Job.dedup_key == dedup_key, Job.status == PENDING).limit(1)
+        if db.session.scalar(pending) is not None:
+            return None
+    job = Job(name=name, args=json.dumps(kwargs), priority=default_priority if priority is None else priority,
+              max_attempts=max_attempts, dedup_key=dedup_key, run_at=utcnow() + datetime.timedelta(seconds=delay))
+    try:
+        with db.session.begin_nested():
+            db.session.add(job)
+    except IntegrityError:
+        # Queued by a concurrent request in the meantime.
+        return None
+    return job
+
+
+def backoff(attempts):
+    return min(current_app.config['JOBS_BACKOFF_SECONDS'] * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+def claim(worker):
+    db, Job = current_app.extensions['jobs']
+    now = utcnow()
+    # SKIP LOCKED lets Postgres workers pass over each other's rows, SQLite has a single
+    # writer and the status check of the UPDATE settles races.
+    query = (select(Job.id).where(Job.status == PENDING, Job.run_at <= now)
+             .order_by(Job.priority.desc(), Job.run_at, Job.id).limit(1).with_for_update(skip_locked=True))
+    job_id = db.session.scalar(query)
+    if job_id is None:
+        db.session.rollback()
+        return None
+    claimed = db.session.execute(
+        update(Job).where(Job.id == job_id, Job.status == PENDING)
+        .values(status=RUNNING, started=now, attempts=Job.attempts + 1, worker=worker)).rowcount
+    db.session.commit()
+    return job_id if claimed else None
+
+
+def perform(job_id):
+    db, Job = current_app.extensions['jobs']
+    job = db.session.get(Job, job_id)
+    name = job.name
+    start = time.perf_counter()
+    try:
+        if name not in tasks:
+            raise LookupError(f"Unknown task {name}")
+        tasks[name][0](**json.loads(job.args))
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Job %s (%s) failed", job_id, name)
+        job = db.session.get(Job, job_id)
+        job.last_error = traceback.format_exc()[-2000:]
+        if job.attempts >= job.max_attempts:
+            job.status = FAILED
+            job.finished = utcnow()
+        else:
+            job.status = PENDING
+            job.run_at = utcnow() + datetime.timedelta(seconds=backoff(job.attempts))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.status = SUPERSEDED
+            job.finished = utcnow()
+            db.session.commit()
+        result = 'error'
+    else:
+        job.status = DONE
+        job.finished = utcnow()
+        db.session.commit()
+        result = 'ok'
+    metrics.observe('job_duration_seconds', time.perf_counter() - start, task=name)
+    metrics.count('jobs_total', task=name, result=result)
+
+
+def requeue_stale():
+    # Jobs left running by a worker that died are given back to the queue.
+    db, Job = current_app.extensions['jobs']
+    limit = utcnow() - datetime.timedelta(seconds=current_app.config['JOBS_TIMEOUT_SECONDS'])
+    for job in db.session.scalars(select(Job).where(Job.status == RUNNING, Job.started < limit)).all():
+        job.status = PENDING if job.attempts < job.max_attempts else FAILED
+        job.last_error = f"Worker {job.worker} stopped while running the job."
+        try:
+            with db.session.begin_nested():
+                db.session.flush()
+        except IntegrityError:
+            job.status = SUPERSEDED
+    db.session.commit()
+
+
+def schedule_periodic():
+    # The next run is queued once the previous one has left the queue.
+    db, Job = current_app.extensions['jobs']
+    for name, seconds in periodic.items():
+        dedup_key = f"periodic:{name}"
+        queued = select(Job.id).where(Job.dedup_key == dedup_key, Job.status.in_([PENDING, RUNNING])).limit(1)
+        if db.session.scalar(queued) is None:
+            enqueue(name, dedup_key=dedup_key, delay=seconds)
+    db.session.commit()
+
+
+def work(app, burst=False, stopping=None):
+    if stopping is None:
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    last_stale_check = 0.0
+    while not stopping:
+        with app.app_context():
+            try:
+                if time.monotonic() - last_stale_check > app.config['JOBS_TIMEOUT_SECONDS'] / 2:
+                    requeue_stale()
+                    last_stale_check = time.monotonic()
+                job_id = claim(worker)
+                if job_id is not None:
+                    perform(job_id)
+                elif not burst:
+                    schedule_periodic()
+                metrics.flush_if_due()
+            except Exception:
+                if burst:
+                    raise
+                # The loop outlives a lost connection: in a gunicorn worker nothing would restart it.
+                db, Job = current_app.extensions['jobs']
+                db.session.rollback()
+                current_app.logger.exception("Worker %s failed, retrying", worker)
+                time.sleep(app.config['JOBS_BACKOFF_SECONDS'])
+                continue
+        if job_id is None:
+            if burst:
+                return
+            time.sleep(app.config['JOBS_POLL_SECONDS'])
+
+
+def start_in_process(app):
+    """Runs the worker loop in a thread of this process, e.g. a gunicorn worker.
+
+    The files the tasks write (QR codes, review matrix, snapshots, metrics) then land on
+    the disk of the instance that serves them. Returns a function stopping the thread.
+    """
+    stopping = []
+    thread = threading.Thread(target=work, args=(app,), kwargs={'stopping': stopping}, name="jobs", daemon=True)
+    thread.start()
+
+    def stop(timeout=None):
+        stopping.append(True)
+        thread.join(timeout)
+
+    return stop
+
+
+def retry_failed():
+    db, Job = current_app.extensions['jobs']
+    for job in db.session.scalars(select(Job).where(Job.status == FAILED)).all():
+        job.status = PENDING
+        job.attempts = 0
+        job.run_at = utcnow()
+        try:
+            with db.session.begin_nested():
+                db.session.flush()
+        except IntegrityError:
+            job.status = SUPERSEDED
+    db.session.commit()
+
+
+def status_counts():
+    db, Job = current_app.extensions['jobs']
+    counts = dict(db.session.execute(select(Job.status, db.func.count(Job.id)).group_by(Job.status)).all())
+    return {status: counts.get(status, 0) for status in STATUSES}
+
+
+def init_app(app, db, model):
+    app.extensions['jobs'] = (db, model)
+    app.config.setdefault('JOBS_EAGER', os.environ.get("JOBS_EAGER") == "1")
+    app.config.setdefault('JOBS_POLL_SECONDS', float(os.environ.get("JOBS_POLL_SECONDS", 1)))
+    app.config.setdefault('JOBS_BACKOFF_SECONDS', float(os.environ.get("JOBS_BACKOFF_SECONDS", 10)))
+    app.config.setdefault('JOBS_TIMEOUT_SECONDS', float(os.environ.get("JOBS_TIMEOUT_SECONDS", 600)))
+
+    @app.cli.command("worker")
+    @click.option('--burst', is_flag=True, help="Exit once the queue is empty.")
+    def worker_command(burst):
+        """Run the queued jobs."""
+        work(app, burst=burst)
@@ -1,49 +1,147 @@
 import datetime
+import json
 import os
+import time
 from functools import wraps
-from urllib.parse import urlencode
-from hashlib import sha256
 
-from flask import Flask, render_template, redirect, url_for, flash, abort
+import click
+from flask import Flask, Blueprint, current_app, render_template, redirect, url_for, flash, abort, jsonify, \
+    has_app_context, make_response, request
 from flask_bootstrap import Bootstrap
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from jinja2 import FileSystemBytecodeCache
 
 from forms import AddBeerForm, ReviewForm, RegisterForm, LoginForm, CommentForm, ForgotPasswordForm, ChangePasswordForm
-from sqlalchemy.orm import relationship
+from forms import SelectionForm
+from sqlalchemy import bindparam, delete, event, func, inspect, literal, select, union_all, update
+from sqlalchemy.orm import deferred, joinedload, relationship, Session, undefer_group
 from sqlalchemy.sql.expression import desc
 
 import random
 import string
-import smtplib
-from email.message import EmailMessage
-
-import qrcode
 
 from flask_talisman import Talisman
 
+import assets
+import avatars
+import compression
+import conditional
+import database
+import instrumentation
+import jobs
+import metrics
+import profiler
+import snapshot
+from database import replica_reads
+
 QR_FOLDER = os.path.join('/static', 'QRs')
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
-app.config['QR_FOLDER'] = QR_FOLDER
-bootstrap = Bootstrap(app)
+db = SQLAlchemy(session_options={'class_': database.RoutingSession})
+bootstrap = Bootstrap()
+login_manager = LoginManager()
+
+# Views and CLI commands are collected here and attached to the app by create_app().
+views = []
+commands = Blueprint('commands', __name__, cli_group=None)
+
+
+def route(rule, **options):
+    def decorator(f):
+        views.append((rule, f, options))
+        return f
+
+    return decorator
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
+    app.config['QR_FOLDER'] = QR_FOLDER
+    app.config['REVIEW_MATRIX_PATH'] = os.environ.get("REVIEW_MATRIX_PATH", "review-matrix.bin")
+    app.config['JINJA_CACHE_DIR'] = os.environ.get("JINJA_CACHE_DIR", os.path.join(app.instance_path, "jinja"))
+    app.config['PRELOAD_TEMPLATES'] = os.environ.get("PRELOAD_TEMPLATES") == "1"
+
+    # CONNECT TO DB
+    database.configure(app)
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+    if config:
+        app.config.update(config)
 
-def gravatar_url(email, size=100, rating='g', default='retro', force_default=False):
-    hash_value = sha256(email.lower().encode('utf-8')).hexdigest()
-    query_params = urlencode({'d': default, 's': str(size), 'r': rating, 'f': force_default})
-    return f"https://www.gravatar.com/avatar/{hash_value}?{query_params}"
+    # Compiled templates are kept on disk so a fresh worker skips the Jinja compile step.
+    os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+    app.jinja_options = {**app.jinja_options,
+                         'bytecode_cache': FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])}
+
+    db.init_app(app)
+    database.init_app(app, db)
+    jobs.init_app(app, db, Job)
+    instrumentation.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    bootstrap.init_app(app)
+    login_manager.init_app(app)
+    assets.init_app(app)
+    avatars.init_app(app)
+    conditional.init_app(app)
+    snapshot.init_app(app)
+    app.jinja_env.filters['gravatar'] = gravatar_url
+
+    for rule, view, options in views:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_blueprint(commands)
+
+    Talisman(app, content_security_policy=None)
+    compression.init_app(app)
+
+    if app.config['PRELOAD_TEMPLATES']:
+        # Under gunicorn --preload this runs once in the master, workers inherit the compiled templates.
+        compile_templates(app)
+
+    # Connections opened before a fork must not be shared with the child process.
+    os.register_at_fork(after_in_child=lambda: dispose_engines(app))
+
+    return app
+
+
+def dispose_engines(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
 
 
-app.jinja_env.filters['gravatar'] = gravatar_url
+def compile_templates(app):
+    names = [name for name in app.jinja_env.list_templates() if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
 
 
-# CONNECT TO DB
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", "sqlite:///brasserie-piron.db")
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+@commands.cli.command("compile-templates")
+def compile_templates_command():
+    names = compile_templates(current_app)
+    print(f"{len(names)} templates compiled to {current_app.config['JINJA_CACHE_DIR']}")
+
+
+@commands.cli.command("upgrade-db")
+def upgrade_db():
+    deleted = database.upgrade_schema(db)
+    reviews = deleted.get(Review.__tablename__, [])
+    if reviews:
+        # The beers still count the reviews that were just dropped.
+        beer_ids = sorted({review['beer_id'] for review in reviews if review['beer_id'] is not None})
+        recalculate_beers(beer_ids)
+        touch_catalogue(db.session)
+        db.session.commit()
+        after_bulk_write([review['id'] for review in reviews])
+        print(f"Recalculated {len(beer_ids)} beers")
+
+
+def gravatar_url(email, size=100):
+    # Avatars are served by /avatar, which keeps a local copy of the gravatar picture or identicon.
+    return url_for('avatar', digest=avatars.email_hash(email), s=size)
 
 
 # CONFIGURE TABLES
@@ -58,11 +156,11 @@ class User(UserMixin, db.Model):
 
     # This will act like a List of Comment objects attached to each User.
     # The "comment_author" refers to the comment_author property in the Comment class.
-    comments = relationship("Comment", back_populates="comment_author")
+    comments = relationship("Comment", back_populates="comment_author", cascade="all, delete", passive_deletes=True)
 
     # This will act like a List of Review objects attached to each User.
     # The "review_author" refers to the review_author property in the Review class.
-    reviews = relationship("Review", back_populates="review_author")
+    reviews = relationship("Review", back_populates="review_author", cascade="all, delete", passive_deletes=True)
 
 
 class Beer(db.Model):
@@ -71,9 +169,10 @@ class Beer(db.Model):
     name = db.Column(db.String(250))
     type = db.Column(db.String(100))
     version = db.Column(db.Integer)
-    malt = db.Column(db.String(250))
-    houblon = db.Column(db.String(250))
-    description = db.Column(db.String(1000))
+    # Only the beer page and its edit form show these, see undefer_group('detail').
+    malt = deferred(db.Column(db.String(250)), group='detail')
+    houblon = deferred(db.Column(db.String(250)), group='detail')
+    description = deferred(db.Column(db.String(1000)), group='detail')
     date = db.Column(db.DateTime)
 
     mousse = db.Column(db.Float)
@@ -97,13 +196,20 @@ class Beer(db.Model):
 
     score = db.Column(db.Float)
 
+    # Radar chart data as JSON, rebuilt with the fields it is made of, see refresh_radar().
+    radar = deferred(db.Column(db.Text))
+
+    # Bumped on every write that changes the beer page, see bump_revisions().
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
     # This will act like a List of Review objects attached to each Beer.
     # The "reviews_beer" refers to the reviews_beer property in the Review class.
-    reviews = relationship("Review", back_populates="reviews_beer")
+    reviews = relationship("Review", back_populates="reviews_beer", cascade="all, delete", passive_deletes=True)
 
     # This will act like a List of Comment objects attached to each Beer.
     # The "comments_beer" refers to the comments_beer property in the Comment class.
-    comments = relationship("Comment", back_populates="comments_beer")
+    comments = relationship("Comment", back_populates="comments_beer", cascade="all, delete", passive_deletes=True)
 
 
 class Review(db.Model):
@@ -131,12 +237,12 @@ class Review(db.Model):
     score = db.Column(db.Integer)
 
     # Create Foreign Key, "beers.id" the users refers to the tablename of Beer.
-    beer_id = db.Column(db.Integer, db.ForeignKey("beers.id"))
+    beer_id = db.Column(db.Integer, db.ForeignKey("beers.id", ondelete='CASCADE'))
     # Create reference to the Beer object, the "reviews" refers to the reviews property in the Beer class.
     reviews_beer = relationship("Beer", back_populates="reviews")
 
     # Create Foreign Key, "users.id" the users refers to the tablename of User.
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete='CASCADE'))
     # Create reference to the User object, the "reviews" refers to the reviews property in the User class.
     review_author = relationship("User", back_populates="reviews")
 
@@ -145,20 +251,135 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
 
     # Create Foreign Key, "users.id" the users refers to the tablename of User.
-    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete='CASCADE'))
     # Create reference to the User object, the "comments" refers to the comments property in the User class.
     comment_author = relationship("User", back_populates="comments")
 
     # Create Foreign Key, "beers.id" the beers refers to the tablename of Beer.
-    beer_id = db.Column(db.Integer, db.ForeignKey("beers.id"))
+    beer_id = db.Column(db.Integer, db.ForeignKey("beers.id", ondelete='CASCADE'))
     # Create reference to the Beer object, the "comments" refers to the comments property in the Beer class.
     comments_beer = relationship("Beer", back_populates="comments")
 
     text = db.Column(db.String(1000))
 
 
-login_manager = LoginManager()
-login_manager.init_app(app)
+class Revision(db.Model):
+    __tablename__ = "revisions"
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
+class Statistic(db.Model):
+    # Figures rebuilt by a job and read as they are by every worker.
+    __tablename__ = "statistics"
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+    updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    args = db.Column(db.Text, nullable=False, default='{}')
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default=jobs.PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    dedup_key = db.Column(db.String(200))
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    worker = db.Column(db.String(100))
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_jobs_queue', 'status', 'priority', 'run_at'),
+        # At most one pending job per deduplication key.
+        db.Index('ix_jobs_pending_dedup_key', 'dedup_key', unique=True,
+                 sqlite_where=db.text("status = 'pending'"), postgresql_where=db.text("status = 'pending'")),
+    )
+
+
+# REVISIONS
+# Beer pages and the album are validated with ETags built from Beer.revision and the
+# "catalogue" revision, so every write that changes them must go through here.
+CATALOGUE = 'catalogue'
+
+
+def touch_beers(session, beer_ids=(), names=()):
+    now = datetime.datetime.utcnow()
+    values = {'revision': Beer.revision + 1, 'updated': now}
+    if beer_ids:
+        session.execute(update(Beer).where(Beer.id.in_(beer_ids)).values(**values),
+                        execution_options={'synchronize_session': False})
+    if names:
+        session.execute(update(Beer).where(Beer.name.in_(names)).values(**values),
+                        execution_options={'synchronize_session': False})
+
+
+def touch_catalogue(session):
+    now = datetime.datetime.utcnow()
+    revision = session.get(Revision, CATALOGUE)
+    if revision is None:
+        session.add(Revision(name=CATALOGUE, value=1, updated=now))
+    else:
+        revision.value = Revision.value + 1
+        revision.updated = now
+    session.info['catalogue_touched'] = True
+
+
+@event.listens_for(Session, "before_flush")
+def bump_revisions(session, flush_context, instances):
+    beers = set()
+    names = set()
+    for item in list(session.new) + list(session.dirty) + list(session.deleted):
+        if item in session.dirty and not session.is_modified(item):
+            continue
+        if isinstance(item, Review):
+            beers.add(item.reviews_beer)
+        elif isinstance(item, Comment):
+            beers.add(item.comments_beer)
+        elif isinstance(item, Beer):
+            beers.add(item)
+            name_history = inspect(item).attrs.name.history
+            if item in session.new or item in session.deleted or name_history.has_changes():
+                # Every version of a beer lists the others.
+                names.update(name for name in name_history.sum() if name is not None)
+        elif isinstance(item, User) and item in session.deleted:
+            beers.update(review.reviews_beer for review in item.reviews)
+            beers.update(comment.comments_beer for comment in item.comments)
+    beers.discard(None)
+    if not beers and not names:
+        return
+
+    now = datetime.datetime.utcnow()
+    for beer in beers:
+        if beer not in session.deleted:
+            beer.revision = Beer.revision + 1 if beer.revision is not None else 1
+            beer.updated = now
+    touch_beers(session, names=names)
+    touch_catalogue(session)
+
+
+@event.listens_for(Session, "before_commit")
+def queue_catalogue_refreshes(session):
+    # What is derived from the catalogue is rebuilt by a job queued with the write.
+    if not has_app_context():
+        return
+    session.flush()
+    if not session.info.pop('catalogue_touched', False):
+        return
+    jobs.enqueue('refresh_dashboard_stats', dedup_key='refresh-dashboard-stats', delay=STATS_DELAY)
+    if current_app.config['SNAPSHOT_DIR'] and not current_app.config['JOBS_EAGER']:
+        jobs.enqueue('refresh_snapshot', dedup_key='refresh-snapshot')
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_catalogue_refreshes(session):
+    session.info.pop('catalogue_touched', None)
 
 
 def admin_only(f):
@@ -171,7 +392,7 @@ def admin_only(f):
     return decorated_function
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
@@ -216,7 +437,7 @@ def load_user(user_id):
     return User.query.get(int(user_id))
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
 
@@ -239,13 +460,13 @@ def login():
     return render_template("login.html", form=form)
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     logout_user()
     return redirect(url_for('home'))
 
 
-@app.route('/change-password', methods=['GET', 'POST'])
+@route('/change-password', methods=['GET', 'POST'])
 def change_password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
@@ -264,7 +485,7 @@ def change_password():
     return render_template("change-password.html", form=form)
 
 
-@app.route('/forgot-password', methods=['GET', 'POST'])
+@route('/forgot-password', methods=['GET', 'POST'])
 def forgot_password():
     form = ForgotPasswordForm()
     if form.validate_on_submit():
@@ -277,23 +498,36 @@ def forgot_password():
             return redirect(url_for('register'))
         else:
             flash("Un nouveau mot de passe a été envoyé à cette adresse mail.")
-            new_password = gen_new_password()
+            jobs.enqueue('reset_password', user_id=user.id, dedup_key=f"reset-password:{user.id}")
+            db.session.commit()
 
-            hash_and_salted_password = generate_password_hash(
-                new_password,
-                method='pbkdf2:sha256',
-                salt_length=8
-            )
+    return render_template("forgot-password.html", form=form)
 
-            user.password = hash_and_salted_password
-            db.session.commit()
 
-            send_email(user.email, new_password)
+@jobs.task('reset_password', priority=10)
+def reset_password(user_id):
+    # The password only changes once the mail is sent, a failed attempt leaves the old one working.
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
+    new_password = gen_new_password()
 
-    return render_template("forgot-password.html", form=form)
+    hash_and_salted_password = generate_password_hash(
+        new_password,
+        method='pbkdf2:sha256',
+        salt_length=8
+    )
 
+    send_email(user.email, new_password)
+    user.password = hash_and_salted_password
+    db.session.commit()
 
+
+@metrics.timed('mail_send_duration_seconds')
 def send_email(email, password):
+    import smtplib
+    from email.message import EmailMessage
+
     message = f"""
     
     Bonjour,
@@ -338,121 +572,413 @@ def gen_new_password():
     return final_str
 
 
-@app.route('/')
+@route('/')
+@replica_reads
 def home():
     return render_template("index.html")
 
 
-@app.route('/beers/<string:sort>')
+@route('/beers/<string:sort>')
+@replica_reads
 def beers(sort):
-    home_beer_list = []
-    beers_query = Beer.query.filter_by(version=1)
-    desc_expression = get_desc(sort)
-    order_by_query = beers_query.order_by(desc_expression)
-    beer_name_list = [beer.name for beer in order_by_query]
-
-    for name in beer_name_list:
-        versioned_beers = Beer.query.filter_by(name=name)
-        versions_list = [beer.version for beer in versioned_beers]
-        max_version = max(versions_list)
-        final_beer = [beer for beer in versioned_beers if beer.version == max_version][0]
-        home_beer_list.append(final_beer)
-
-    is_reviewed_list = []
-    for beer in home_beer_list:
-        review_list = [item for item in beer.reviews]
-        if current_user.is_authenticated:
-            users_list = [review.review_author for review in review_list]
-            is_reviewed = current_user in users_list
-        else:
-            is_reviewed = False
-        is_reviewed_list.append(is_reviewed)
-
-    beer_list = [(home_beer_list[i], is_reviewed_list[i]) for i in range(len(home_beer_list))]
-
-    return render_template("beer-album.html", beers=beer_list, sort=sort)
-
-
-def get_desc(sort):
-    if sort == 'note':
-        desc_expr = desc(Beer.score)
-    if sort == 'date':
-        desc_expr = desc(Beer.date)
-    if sort == 'mousse':
-        desc_expr = desc(Beer.mousse)
-    if sort == 'couleur':
-        desc_expr = desc(Beer.couleur)
-    if sort == 'opacité':
-        desc_expr = desc(Beer.opacite)
-    if sort == 'pétillant':
-        desc_expr = desc(Beer.petillant)
-    if sort == 'douceur':
-        desc_expr = desc(Beer.douceur)
-    if sort == 'amertume':
-        desc_expr = desc(Beer.amertume)
-    if sort == 'acidité':
-        desc_expr = desc(Beer.acidite)
-    if sort == 'gushing':
-        desc_expr = desc(Beer.gushing)
-    if sort == 'alcooleux':
-        desc_expr = desc(Beer.alcooleux)
-    if sort == 'fruité':
-        desc_expr = desc(Beer.fruite)
-    if sort == 'floral':
-        desc_expr = desc(Beer.floral)
-    if sort == 'houblonné':
-        desc_expr = desc(Beer.houblonne)
-    if sort == 'boisé':
-        desc_expr = desc(Beer.boise)
-    if sort == 'torréfié':
-        desc_expr = desc(Beer.torrefie)
-    if sort == 'herbeux':
-        desc_expr = desc(Beer.herbeux)
-    if sort == 'céréales':
-        desc_expr = desc(Beer.cereales)
-    if sort == 'épicé':
-        desc_expr = desc(Beer.epice)
-    return desc_expr
-
-
-@app.route('/beer/<int:beer_id>')
+    if sort not in SORT_COLUMNS:
+        abort(404)
+    catalogue = db.session.get(Revision, CATALOGUE)
+    last_modified = catalogue.updated if catalogue else None
+    # The reviewed marks of the user change only with their reviews, which bump the catalogue.
+    etag = conditional.make_etag('beers', sort, catalogue.value if catalogue else 0)
+    cached = conditional.check(etag, last_modified)
+    if cached is not None:
+        return cached
+
+    # Latest version of each beer, ordered by the first version as the album always was.
+    first = select(Beer.name, SORT_COLUMNS[sort].label('key'),
+                   func.row_number().over(partition_by=Beer.name, order_by=Beer.id).label('rank')) \
+        .where(Beer.version == 1).subquery()
+    latest = select(Beer.id, func.row_number().over(partition_by=Beer.name,
+                                                    order_by=(Beer.version.desc(), Beer.id)).label('rank')).subquery()
+    album = db.session.execute(
+        select(*ALBUM_COLUMNS)
+        .join(latest, latest.c.id == Beer.id).join(first, first.c.name == Beer.name)
+        .where(latest.c.rank == 1, first.c.rank == 1)
+        .order_by(desc(first.c.key), Beer.id)).all()
+
+    reviewed = set()
+    if current_user.is_authenticated:
+        reviewed = set(db.session.scalars(select(Review.beer_id).where(Review.author_id == current_user.id)))
+    beer_list = [(row, row.id in reviewed) for row in album]
+
+    response = make_response(render_template("beer-album.html", beers=beer_list, sort=sort))
+    return conditional.validators(response, etag, last_modified)
+
+
+SORT_COLUMNS = {
+    'note': Beer.score,
+    'date': Beer.date,
+    'mousse': Beer.mousse,
+    'couleur': Beer.couleur,
+    'opacité': Beer.opacite,
+    'pétillant': Beer.petillant,
+    'douceur': Beer.douceur,
+    'amertume': Beer.amertume,
+    'acidité': Beer.acidite,
+    'gushing': Beer.gushing,
+    'alcooleux': Beer.alcooleux,
+    'fruité': Beer.fruite,
+    'floral': Beer.floral,
+    'houblonné': Beer.houblonne,
+    'boisé': Beer.boise,
+    'torréfié': Beer.torrefie,
+    'herbeux': Beer.herbeux,
+    'céréales': Beer.cereales,
+    'épicé': Beer.epice,
+}
+
+# Listing pages only show these columns, they are read as plain rows rather than Beer objects.
+LISTING_COLUMNS = [Beer.id, Beer.name, Beer.type, Beer.version, Beer.date, Beer.score]
+ALBUM_COLUMNS = [Beer.id, Beer.name, Beer.type] + list(SORT_COLUMNS.values())
+
+
+def beer_listing():
+    return db.session.execute(select(*LISTING_COLUMNS).order_by(Beer.id)).all()
+
+
+@route('/beer/<int:beer_id>')
+@replica_reads
 def beer(beer_id):
-    selected_beer = Beer.query.get(beer_id)
-    all_versions = Beer.query.filter_by(name=selected_beer.name)
+    revision = db.session.execute(select(Beer.revision, Beer.updated).where(Beer.id == beer_id)).first()
+    if revision is None:
+        abort(404)
+    review_id = 0
+    if current_user.is_authenticated:
+        review_id = db.session.scalar(
+            select(Review.id).where(Review.beer_id == beer_id, Review.author_id == current_user.id).limit(1)) or 0
+    is_reviewed = review_id != 0
+    etag = conditional.make_etag('beer', beer_id, revision.revision, int(is_reviewed))
+    cached = conditional.check(etag, revision.updated)
+    if cached is not None:
+        return cached
+
+    selected_beer = db.session.get(Beer, beer_id, options=[undefer_group('detail')])
+    all_versions = db.session.execute(
+        select(Beer.id, Beer.version).where(Beer.name == selected_beer.name).order_by(Beer.id)).all()
     versions_list = [item for item in all_versions]
     n_versions = len(versions_list)
-    review_list = [item for item in selected_beer.reviews]
-    n_reviews = len(review_list)
-    if current_user.is_authenticated:
-        users_list = [review.review_author for review in review_list]
-        is_reviewed = current_user in users_list
-    else:
-        is_reviewed = False
-    if is_reviewed:
-        selected_review = [review for review in review_list if review.review_author == current_user]
-        review_id = selected_review[0].id
-    else:
-        review_id = 0
+    n_reviews = db.session.scalar(select(func.count(Review.id)).where(Review.beer_id == beer_id))
+    previous_version = max((version for version in versions_list if version.version < selected_beer.version),
+                           key=lambda version: version.version, default=None)
     comments = Comment.query.filter_by(comments_beer=selected_beer)
-    return render_template("beer.html", beer=selected_beer, all_versions=all_versions, n_reviews=n_reviews,
-                           is_reviewed=is_reviewed, review_id=review_id, comments=comments, n_versions=n_versions)
+    response = make_response(render_template("beer.html", beer=selected_beer, all_versions=all_versions,
+                                             n_reviews=n_reviews, is_reviewed=is_reviewed, review_id=review_id,
+                                             comments=comments, n_versions=n_versions,
+                                             previous_version=previous_version))
+    return conditional.validators(response, etag, revision.updated)
+
+
+# SNAPSHOT
+def snapshot_pages():
+    # Versions of the public pages: the album follows the catalogue revision, a beer page its own.
+    catalogue = db.session.get(Revision, CATALOGUE)
+    catalogue_version = catalogue.value if catalogue else 0
+    pages = {'/': 0}
+    pages.update({f"/beers/{sort}": catalogue_version for sort in SORT_COLUMNS})
+    pages.update({f"/beer/{beer_id}": revision for beer_id, revision in db.session.execute(
+        select(Beer.id, Beer.revision))})
+    return pages
+
+
+@jobs.task('refresh_snapshot', priority=-5)
+def refresh_snapshot(full=False):
+    return snapshot.sync(snapshot_pages(), full=full)
+
+
+@commands.cli.command("snapshot")
+@click.option('--full', is_flag=True, help="Render every page, not only the changed ones.")
+def snapshot_command(full):
+    if not current_app.config['SNAPSHOT_DIR']:
+        raise click.ClickException("SNAPSHOT_DIR is not set.")
+    rendered, removed = refresh_snapshot(full=full)
+    print(f"{rendered} pages rendered, {removed} removed in {current_app.config['SNAPSHOT_DIR']}")
+
+
+# COMPARE
+RADAR_LABELS = {
+    'mousse': "Mousse",
+    'couleur': "Couleur",
+    'opacite': "Opacité",
+    'petillant': "Pétillant",
+    'douceur': "Douceur",
+    'amertume': "Amertume",
+    'acidite': "Acidité",
+    'gushing': "Gushing",
+    'alcooleux': "Alcooleux",
+    'fruite': "Fruité",
+    'floral': "Floral",
+    'houblonne': "Houblonné",
+    'boise': "Boisé",
+    'torrefie': "Torréfié",
+    'herbeux': "Herbeux",
+    'cereales': "Céréales",
+    'epice': "Epicé",
+}
+RADAR_FIELDS = ['name', 'type', 'version', 'score'] + list(RADAR_LABELS)
+COMPARE_LIMIT = 6
+
+
+def radar_payload(fields):
+    return json.dumps({
+        'name': fields['name'],
+        'type': fields['type'],
+        'version': fields['version'],
+        'score': round(float(fields['score'] or 0), 1),
+        'values': [round(float(fields[attribute] or 0), 2) for attribute in RADAR_LABELS],
+    })
+
+
+@event.listens_for(Session, "before_flush")
+def refresh_radar(session, flush_context, instances):
+    for item in list(session.new) + list(session.dirty):
+        if not isinstance(item, Beer):
+            continue
+        state = inspect(item)
+        if item in session.new or any(state.attrs[field].history.has_changes() for field in RADAR_FIELDS):
+            item.radar = radar_payload({field: getattr(item, field) for field in RADAR_FIELDS})
+
+
+def compare_rows():
+    beer_ids = list(dict.fromkeys(request.args.getlist('ids', type=int)))
+    if not beer_ids or len(beer_ids) > COMPARE_LIMIT:
+        abort(400)
+    rows = {row.id: row for row in db.session.execute(
+        select(Beer.id, Beer.revision, Beer.updated, Beer.radar).where(Beer.id.in_(beer_ids)))}
+    if not rows:
+        abort(404)
+    return [rows[beer_id] for beer_id in beer_ids if beer_id in rows]
+
+
+def compare_validators(kind, rows):
+    etag = conditional.make_etag(kind, *[f"{row.id}-{row.revision}" for row in rows])
+    return etag, max((row.updated for row in rows if row.updated), default=None)
+
+
+def compare_payloads(rows):
+    # Beers written before the radar column existed are computed from their columns.
+    missing = [row.id for row in rows if row.radar is None]
+    computed = {}
+    if missing:
+        computed = {row.id: radar_payload(row._mapping) for row in db.session.execute(
+            select(Beer.id, *[getattr(Beer, field) for field in RADAR_FIELDS]).where(Beer.id.in_(missing)))}
+    return [{'id': row.id, **json.loads(row.radar or computed[row.id])} for row in rows]
+
+
+@route('/compare')
+@replica_reads
+def compare():
+    rows = compare_rows()
+    etag, last_modified = compare_validators('compare', rows)
+    cached = conditional.check(etag, last_modified)
+    if cached is not None:
+        return cached
+    response = make_response(render_template("compare.html", beers=compare_payloads(rows),
+                                             labels=list(RADAR_LABELS.values())))
+    return conditional.validators(response, etag, last_modified)
+
+
+@route('/api/compare')
+@replica_reads
+def compare_api():
+    rows = compare_rows()
+    etag, last_modified = compare_validators('compare-api', rows)
+    cached = conditional.check(etag, last_modified)
+    if cached is not None:
+        return cached
+    response = jsonify(attributes=list(RADAR_LABELS), labels=list(RADAR_LABELS.values()),
+                       beers=compare_payloads(rows))
+    return conditional.validators(response, etag, last_modified)
 
 
 # ADMIN ZONE
-@app.route('/admin')
+@route('/admin')
+@replica_reads
 @admin_only
 def admin():
-    return render_template("admin.html")
+    return render_template("admin.html", stats=get_dashboard_stats())
+
+
+# Dashboard figures are computed by a job into the statistics table, so /admin reads one row
+# whatever the size of the reviews. Writes queue the job at most every STATS_DELAY seconds.
+DASHBOARD = 'dashboard'
+STATS_DELAY = 60
+
+
+def get_dashboard_stats():
+    stored = db.session.get(Statistic, DASHBOARD)
+    if stored is not None:
+        metrics.count('cache_requests_total', cache='dashboard', result='hit')
+        return {**json.loads(stored.value), 'updated': stored.updated}
+    # Nothing was written since the table was created, the figures are computed once here.
+    metrics.count('cache_requests_total', cache='dashboard', result='miss')
+    return {**compute_dashboard_stats(), 'updated': None}
+
+
+@jobs.task('refresh_dashboard_stats', priority=-5)
+def refresh_dashboard_stats():
+    db.session.merge(Statistic(name=DASHBOARD, value=json.dumps(compute_dashboard_stats()),
+                               updated=datetime.datetime.utcnow()))
+
+
+def compute_dashboard_stats():
+    import review_matrix
+
+    histogram_query = union_all(*[
+        select(literal(attribute).label('attribute'), getattr(Review, attribute).label('value'), func.count())
+        .group_by(getattr(Review, attribute))
+        for attribute in review_matrix.ATTRIBUTES
+    ])
+    histograms = {attribute: [0] * 11 for attribute in review_matrix.ATTRIBUTES}
+    for attribute, value, count in db.session.execute(histogram_query):
+        if value is not None and 0 <= value <= 10:
+            histograms[attribute][value] = count
+
+    n_reviews = func.count(Review.id).label('n_reviews')
+    reviews_per_beer = db.session.execute(
+        select(Beer.id, Beer.name, Beer.version, n_reviews)
+        .outerjoin(Review, Review.beer_id == Beer.id)
+        .group_by(Beer.id, Beer.name, Beer.version)
+        .order_by(desc(n_reviews))
+        .limit(10)
+    ).all()
+
+    active_reviewers = db.session.execute(
+        select(User.id, User.name, User.surname, n_reviews)
+        .join(Review, Review.author_id == User.id)
+        .group_by(User.id, User.name, User.surname)
+        .order_by(desc(n_reviews))
+        .limit(10)
+    ).all()
+
+    n_comments = func.count(Comment.id).label('n_comments')
+    comments_per_beer = db.session.execute(
+        select(Beer.id, Beer.name, Beer.version, n_comments)
+        .join(Comment, Comment.beer_id == Beer.id)
+        .group_by(Beer.id, Beer.name, Beer.version)
+        .order_by(desc(n_comments))
+        .limit(10)
+    ).all()
+
+    return {
+        'histograms': histograms,
+        'reviews_per_beer': [row._asdict() for row in reviews_per_beer],
+        'active_reviewers': [row._asdict() for row in active_reviewers],
+        'comments_per_beer': [row._asdict() for row in comments_per_beer],
+    }
+
+
+@route('/metrics')
+def metrics_endpoint():
+    # Scrapers authenticate with METRICS_TOKEN, admins with their session.
+    if not metrics.authorized() and not (current_user.is_authenticated and current_user.is_admin):
+        return abort(403)
+    return metrics.metrics_view()
+
+
+@route('/admin-profiles')
+@admin_only
+def admin_profiles():
+    profiles = profiler.list_profiles(current_app.config['PROFILE_DIR'])
+    return render_template("admin-profiles.html", profiles=profiles)
 
 
-@app.route('/admin-add-beer-page')
+@route('/admin-profile/<string:page>/<string:name>')
+@admin_only
+def admin_profile(page, name):
+    try:
+        stacks = profiler.load(current_app.config['PROFILE_DIR'], page, name)
+    except FileNotFoundError:
+        return abort(404)
+    rectangles, max_depth = profiler.flame_graph(stacks)
+    return render_template("admin-profile.html", page=page, name=name, rectangles=rectangles,
+                           max_depth=max_depth, row_height=profiler.ROW_HEIGHT, n_samples=sum(stacks.values()))
+
+
+@route('/admin-jobs')
+@replica_reads
+@admin_only
+def admin_jobs():
+    recent = Job.query.order_by(Job.id.desc()).limit(50).all()
+    failed = Job.query.filter_by(status=jobs.FAILED).order_by(Job.finished.desc()).limit(20).all()
+    return render_template("admin-jobs.html", counts=jobs.status_counts(), recent=recent, failed=failed,
+                           form=SelectionForm())
+
+
+@route('/admin-jobs/retry', methods=['POST'])
+@admin_only
+def admin_jobs_retry():
+    if SelectionForm().validate_on_submit():
+        jobs.retry_failed()
+    return redirect(url_for('admin_jobs'))
+
+
+@route('/admin-jobs/refresh-review-matrix', methods=['POST'])
+@admin_only
+def admin_jobs_refresh_review_matrix():
+    if SelectionForm().validate_on_submit():
+        jobs.enqueue('refresh_review_matrix', dedup_key='refresh-review-matrix')
+        db.session.commit()
+        flash("La reconstruction de la matrice des fiches a été programmée.")
+    return redirect(url_for('admin_jobs'))
+
+
+@route('/admin-db-pool')
+@admin_only
+def admin_db_pool():
+    return jsonify(database.pool_status(db))
+
+
+@route('/admin-analytics')
+@admin_only
+def admin_analytics():
+    import review_matrix
+
+    matrix = review_matrix.load(current_app.config['REVIEW_MATRIX_PATH'])
+    bias = review_matrix.author_bias(matrix)
+    authors = {user.id: user for user in User.query.filter(User.id.in_([item[0] for item in bias]))}
+    return render_template("admin-analytics.html", n_reviews=len(matrix), attributes=review_matrix.ATTRIBUTES,
+                           distributions=review_matrix.distributions(matrix),
+                           correlations=review_matrix.correlations(matrix),
+                           bias=[(authors.get(author_id), value, count) for author_id, value, count in bias])
+
+
+@jobs.task('refresh_review_matrix', priority=-10, every=3600)
+def rebuild_review_matrix():
+    import review_matrix
+
+    columns = [getattr(Review, attribute) for attribute in review_matrix.ATTRIBUTES]
+    query = db.session.query(Review.id, Review.beer_id, Review.author_id, *columns).order_by(Review.id)
+
+    def newer(last_id):
+        # A new transaction sees the reviews committed while the snapshot was written.
+        db.session.commit()
+        return query.filter(Review.id > last_id).all()
+
+    return review_matrix.refresh(current_app.config['REVIEW_MATRIX_PATH'], query.yield_per(10000), newer)
+
+
+@commands.cli.command("refresh-review-matrix")
+def refresh_review_matrix():
+    count = rebuild_review_matrix()
+    print(f"{count} reviews written to {current_app.config['REVIEW_MATRIX_PATH']}")
+
+
+@route('/admin-add-beer-page')
+@replica_reads
 @admin_only
 def admin_add_beer_page():
-    beers = Beer.query.all()
+    beers = beer_listing()
     return render_template("admin-add-beer-page.html", beers=beers)
 
 
-@app.route('/admin-add-beer', methods=['GET', 'POST'])
+@route('/admin-add-beer', methods=['GET', 'POST'])
 @admin_only
 def admin_add_beer():
     form = AddBeerForm()
@@ -485,38 +1011,41 @@ def admin_add_beer():
             epice=0
         )
         db.session.add(new_beer)
+        db.session.flush()
+        jobs.enqueue('create_qr', id=new_beer.id)
         db.session.commit()
-        create_qr(new_beer.id)
         return redirect(url_for("admin_add_beer_page"))
     return render_template("admin-form.html", form=form)
 
 
-@app.route('/admin-qr-page')
+@route('/admin-qr-page')
+@replica_reads
 @admin_only
 def admin_qr_page():
-    beers = Beer.query.all()
+    beers = beer_listing()
     return render_template("admin-qr-page.html", beers=beers)
 
 
-@app.route("/admin-qr/<int:beer_id>")
+@route("/admin-qr/<int:beer_id>")
 @admin_only
 def admin_qr(beer_id):
     beer = Beer.query.get(beer_id)
-    path = os.path.join(app.config['QR_FOLDER'], f"qr_{beer.id}.png")
+    path = os.path.join(current_app.config['QR_FOLDER'], f"qr_{beer.id}.png")
     return render_template("admin-qr.html", beer=beer, path=path)
 
 
-@app.route('/admin-edit-beer-page')
+@route('/admin-edit-beer-page')
+@replica_reads
 @admin_only
 def admin_edit_beer_page():
-    beers = Beer.query.all()
-    return render_template("admin-edit-beer-page.html", beers=beers)
+    beers = beer_listing()
+    return render_template("admin-edit-beer-page.html", beers=beers, form=SelectionForm())
 
 
-@app.route("/admin-edit-beer/<int:beer_id>", methods=['GET', 'POST'])
+@route("/admin-edit-beer/<int:beer_id>", methods=['GET', 'POST'])
 @admin_only
 def admin_edit_beer(beer_id):
-    beer_to_edit = Beer.query.get(beer_id)
+    beer_to_edit = db.session.get(Beer, beer_id, options=[undefer_group('detail')])
     edit_form = AddBeerForm(
         name=beer_to_edit.name,
         type=beer_to_edit.type,
@@ -540,81 +1069,232 @@ def admin_edit_beer(beer_id):
     return render_template("admin-form.html", form=edit_form)
 
 
-@app.route('/admin-delete-beer-page')
+@route('/admin-delete-beer-page')
+@replica_reads
 @admin_only
 def admin_delete_beer_page():
-    beers = Beer.query.all()
-    return render_template("admin-delete-beer-page.html", beers=beers)
+    beers = beer_listing()
+    return render_template("admin-delete-beer-page.html", beers=beers, form=SelectionForm())
 
 
-@app.route("/admin-delete-beer/<int:beer_id>")
+@route("/admin-delete-beer/<int:beer_id>")
 @admin_only
 def admin_delete_beer(beer_id):
-    beer_to_delete = Beer.query.get(beer_id)
-    db.session.delete(beer_to_delete)
-    db.session.commit()
+    delete_beers([beer_id])
     return redirect(url_for('admin_delete_beer_page'))
 
 
-@app.route('/admin-edit-review-page')
+@route("/admin-delete-beers", methods=['POST'])
+@admin_only
+def admin_delete_beers():
+    if SelectionForm().validate_on_submit():
+        delete_beers(selected_ids())
+    return redirect(url_for('admin_delete_beer_page'))
+
+
+@route("/admin-recalculate-beers", methods=['POST'])
+@admin_only
+def admin_recalculate_beers():
+    if SelectionForm().validate_on_submit():
+        recalculate_beers(selected_ids())
+        touch_catalogue(db.session)
+        db.session.commit()
+    return redirect(url_for('admin_edit_beer_page'))
+
+
+def review_listing():
+    return db.session.scalars(select(Review).order_by(Review.id).options(
+        joinedload(Review.reviews_beer).load_only(Beer.name, Beer.version),
+        joinedload(Review.review_author).load_only(User.name))).all()
+
+
+@route('/admin-edit-review-page')
+@replica_reads
 @admin_only
 def admin_edit_review_page():
-    reviews = Review.query.all()
+    reviews = review_listing()
     return render_template("admin-edit-review-page.html", reviews=reviews)
 
 
-@app.route('/admin-delete-review-page')
+@route('/admin-delete-review-page')
+@replica_reads
 @admin_only
 def admin_delete_review_page():
-    reviews = Review.query.all()
-    return render_template("admin-delete-review-page.html", reviews=reviews)
+    reviews = review_listing()
+    return render_template("admin-delete-review-page.html", reviews=reviews, form=SelectionForm())
 
 
-@app.route("/admin-delete-review/<int:review_id>")
+@route("/admin-delete-review/<int:review_id>")
 @admin_only
 def admin_delete_review(review_id):
-    review_to_delete = Review.query.get(review_id)
-    beer_id = review_to_delete.reviews_beer.id
-    db.session.delete(review_to_delete)
-    db.session.commit()
-    beer_to_update = Beer.query.get(beer_id)
-    all_reviews = beer_to_update.reviews
-    recalculate_beer(beer_to_update, all_reviews)
+    delete_reviews([review_id])
+    return redirect(url_for('admin_delete_review_page'))
+
+
+@route("/admin-delete-reviews", methods=['POST'])
+@admin_only
+def admin_delete_reviews():
+    if SelectionForm().validate_on_submit():
+        delete_reviews(selected_ids())
     return redirect(url_for('admin_delete_review_page'))
 
 
-@app.route('/admin-delete-user-page')
+@route('/admin-delete-user-page')
+@replica_reads
 @admin_only
 def admin_delete_user_page():
     users = User.query.all()
-    return render_template("admin-delete-user-page.html", users=users)
+    return render_template("admin-delete-user-page.html", users=users, form=SelectionForm())
 
 
-@app.route("/admin-delete-user/<int:user_id>")
+@route("/admin-delete-user/<int:user_id>")
 @admin_only
 def admin_delete_user(user_id):
-    user_to_delete = User.query.get(user_id)
-    db.session.delete(user_to_delete)
-    db.session.commit()
+    delete_users([user_id])
+    return redirect(url_for('admin_delete_user_page'))
+
+
+@route("/admin-delete-users", methods=['POST'])
+@admin_only
+def admin_delete_users():
+    if SelectionForm().validate_on_submit():
+        user_ids = selected_ids()
+        if current_user.id in user_ids:
+            user_ids.remove(current_user.id)
+            flash("Vous ne pouvez pas supprimer votre propre compte.")
+        delete_users(user_ids)
     return redirect(url_for('admin_delete_user_page'))
 
 
-@app.route('/admin-edit-user-page')
+@route('/admin-edit-user-page')
+@replica_reads
 @admin_only
 def admin_edit_user_page():
     users = User.query.all()
-    return render_template("admin-edit-user-page.html", users=users)
+    return render_template("admin-edit-user-page.html", users=users, form=SelectionForm())
 
 
-@app.route("/admin-edit-user/<int:user_id>")
+@route("/admin-edit-user/<int:user_id>")
 @admin_only
 def admin_edit_user(user_id):
+    if user_id == current_user.id:
+        flash("Vous ne pouvez pas retirer vos propres droits d'administrateur.")
+        return redirect(url_for('admin_edit_user_page'))
     user_to_edit = User.query.get(user_id)
     user_to_edit.is_admin = not user_to_edit.is_admin
     db.session.commit()
     return redirect(url_for('admin_edit_user_page'))
 
 
+@route("/admin-edit-users", methods=['POST'])
+@admin_only
+def admin_edit_users():
+    if SelectionForm().validate_on_submit():
+        is_admin = request.form.get('action') == 'grant'
+        user_ids = selected_ids()
+        if not is_admin and current_user.id in user_ids:
+            user_ids.remove(current_user.id)
+            flash("Vous ne pouvez pas retirer vos propres droits d'administrateur.")
+        for batch in batches(user_ids):
+            db.session.execute(update(User).where(User.id.in_(batch)).values(is_admin=is_admin))
+        db.session.commit()
+    return redirect(url_for('admin_edit_user_page'))
+
+
+# BULK OPERATIONS
+# Set-based statements: reviews and comments go with their beer or author through ON DELETE
+# CASCADE, and each affected beer is recomputed once per batch. These writes bypass the
+# session hooks, so revisions, dashboard stats and the review matrix are updated here.
+BATCH_SIZE = 500
+
+
+def batches(ids, size=BATCH_SIZE):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def selected_ids():
+    return request.form.getlist('ids', type=int)
+
+
+def recalculate_beers(beer_ids):
+    import review_matrix
+
+    attributes = review_matrix.ATTRIBUTES
+    beers_table = Beer.__table__
+    averages_query = select(Review.beer_id, *[func.avg(getattr(Review, attribute), type_=db.Float)
+                                               for attribute in attributes])
+    statement = update(beers_table).where(beers_table.c.id == bindparam('beer_id')).values(
+        revision=beers_table.c.revision + 1, updated=datetime.datetime.utcnow(), radar=bindparam('new_radar'),
+        **{attribute: bindparam(f"new_{attribute}") for attribute in attributes})
+
+    for batch in batches(beer_ids):
+        averages = {row[0]: row[1:] for row in
+                    db.session.execute(averages_query.where(Review.beer_id.in_(batch)).group_by(Review.beer_id))}
+        identities = {row.id: row._mapping for row in db.session.execute(
+            select(Beer.id, Beer.name, Beer.type, Beer.version).where(Beer.id.in_(batch)))}
+        rows = []
+        for beer_id in batch:
+            if beer_id not in identities:
+                continue
+            values = [value or 0 for value in averages.get(beer_id, [0] * len(attributes))]
+            values[-1] = round(values[-1], 1)
+            fields = {**identities[beer_id], **dict(zip(attributes, values))}
+            rows.append({'beer_id': beer_id, 'new_radar': radar_payload(fields),
+                         **{f"new_{name}": value for name, value in zip(attributes, values)}})
+        if rows:
+            db.session.execute(statement, rows)
+
+
+def after_bulk_write(review_ids=()):
+    import review_matrix
+
+    review_matrix.discard(current_app.config['REVIEW_MATRIX_PATH'], review_ids)
+
+
+def delete_beers(beer_ids):
+    review_ids = []
+    for batch in batches(beer_ids):
+        review_ids += db.session.scalars(select(Review.id).where(Review.beer_id.in_(batch))).all()
+        names = db.session.scalars(select(Beer.name).where(Beer.id.in_(batch)).distinct()).all()
+        db.session.execute(delete(Beer).where(Beer.id.in_(batch)))
+        # The remaining versions list the deleted ones.
+        touch_beers(db.session, names=names)
+    touch_catalogue(db.session)
+    db.session.commit()
+    after_bulk_write(review_ids)
+
+
+def delete_reviews(review_ids):
+    beer_ids = set()
+    for batch in batches(review_ids):
+        beer_ids.update(db.session.scalars(select(Review.beer_id).where(Review.id.in_(batch))))
+        db.session.execute(delete(Review).where(Review.id.in_(batch)))
+    recalculate_beers(beer_ids)
+    touch_catalogue(db.session)
+    db.session.commit()
+    after_bulk_write(review_ids)
+
+
+def delete_users(user_ids):
+    review_ids = []
+    reviewed = set()
+    commented = set()
+    for batch in batches(user_ids):
+        authored = select(Review.id, Review.beer_id).where(Review.author_id.in_(batch))
+        for review_id, beer_id in db.session.execute(authored):
+            review_ids.append(review_id)
+            reviewed.add(beer_id)
+        commented.update(db.session.scalars(select(Comment.beer_id).where(Comment.author_id.in_(batch))))
+        db.session.execute(delete(User).where(User.id.in_(batch)))
+    recalculate_beers(reviewed)
+    touch_beers(db.session, beer_ids=commented - reviewed)
+    touch_catalogue(db.session)
+    db.session.commit()
+    after_bulk_write(review_ids)
+
+
 # REVIEWS
 def get_avg(list):
     sum = 0
@@ -633,6 +1313,19 @@ def get_avg(list):
     return avg
 
 
+def enqueue_recalculate(beer_id):
+    # One pending recomputation per beer, however many reviews land before the worker gets to it.
+    jobs.enqueue('recalculate_beer', beer_id=beer_id, dedup_key=f"recalculate-beer:{beer_id}")
+
+
+@jobs.task('recalculate_beer', priority=5)
+def recalculate_beer_job(beer_id):
+    beer_to_update = db.session.get(Beer, beer_id)
+    if beer_to_update is not None:
+        recalculate_beer(beer_to_update, beer_to_update.reviews)
+
+
+@metrics.timed('recalculate_beer_duration_seconds')
 def recalculate_beer(beer_to_be_reviewed, all_reviews):
     mousse_list = [review.mousse for review in all_reviews]
     mousse_avg = get_avg(mousse_list)
@@ -709,7 +1402,7 @@ def recalculate_beer(beer_to_be_reviewed, all_reviews):
     db.session.commit()
 
 
-@app.route("/review/<int:beer_id>/<int:new_mousse>/<int:new_couleur>/<int:new_opacite>/"
+@route("/review/<int:beer_id>/<int:new_mousse>/<int:new_couleur>/<int:new_opacite>/"
            "<int:new_petillant>/<int:new_douceur>/<int:new_amertume>/<int:new_acidite>/<int:new_gushing>/"
            "<int:new_alcooleux>/<int:new_fruite>/<int:new_floral>/"
            "<int:new_houblonne>/<int:new_boise>/<int:new_torrefie>/<int:new_herbeux>/"
@@ -736,6 +1429,8 @@ def review(beer_id,
            new_epice,
            new_score,
            scroll):
+    import review_matrix
+
     if not current_user.is_authenticated:
         flash("Vous devez vous identifier pour remplir une fiche de dégustation.")
         return redirect(url_for("login"))
@@ -790,12 +1485,9 @@ def review(beer_id,
         )
 
         db.session.add(new_review)
+        enqueue_recalculate(beer_id)
         db.session.commit()
-
-        beer_to_be_reviewed = Beer.query.get(beer_id)
-        all_reviews = beer_to_be_reviewed.reviews
-
-        recalculate_beer(beer_to_be_reviewed, all_reviews)
+        review_matrix.append(current_app.config['REVIEW_MATRIX_PATH'], [new_review])
 
         return redirect(url_for("beer", beer_id=beer_id))
     return render_template("review-beer.html", form=form, beer=beer_to_be_reviewed, scroll=scroll,
@@ -819,7 +1511,7 @@ def review(beer_id,
                            new_score=new_score)
 
 
-@app.route("/review_edit/<int:review_id>", methods=['GET', 'POST'])
+@route("/review_edit/<int:review_id>", methods=['GET', 'POST'])
 def review_edit_fetch(review_id):
     review_to_edit = Review.query.get(review_id)
 
@@ -852,7 +1544,7 @@ def review_edit_fetch(review_id):
                             new_score=new_score, scroll='None'))
 
 
-@app.route("/review-edit/<int:review_id>/<int:new_mousse>/<int:new_couleur>/<int:new_opacite>/"
+@route("/review-edit/<int:review_id>/<int:new_mousse>/<int:new_couleur>/<int:new_opacite>/"
            "<int:new_petillant>/<int:new_douceur>/<int:new_amertume>/<int:new_acidite>/<int:new_gushing>/"
            "<int:new_alcooleux>/<int:new_fruite>/<int:new_floral>/"
            "<int:new_houblonne>/<int:new_boise>/<int:new_torrefie>/<int:new_herbeux>/"
@@ -866,6 +1558,8 @@ def review_edit(review_id,
                 new_floral, new_houblonne, new_boise,
                 new_torrefie, new_herbeux, new_cereales,
                 new_epice, new_score, scroll):
+    import review_matrix
+
     review_to_edit = Review.query.get(review_id)
     beer_to_be_reviewed = review_to_edit.reviews_beer
 
@@ -911,11 +1605,9 @@ def review_edit(review_id,
 
         review_to_edit.score = form.score.data
 
+        enqueue_recalculate(beer_to_be_reviewed.id)
         db.session.commit()
-
-        all_reviews = beer_to_be_reviewed.reviews
-
-        recalculate_beer(beer_to_be_reviewed, all_reviews)
+        review_matrix.update(current_app.config['REVIEW_MATRIX_PATH'], review_to_edit)
 
         return redirect(url_for("beer", beer_id=beer_to_be_reviewed.id))
     return render_template("review-beer-edit.html", form=form, beer=beer_to_be_reviewed,
@@ -929,7 +1621,7 @@ def review_edit(review_id,
                            new_score=new_score)
 
 
-@app.route("/add-comment/<int:beer_id>", methods=['GET', 'POST'])
+@route("/add-comment/<int:beer_id>", methods=['GET', 'POST'])
 def add_comment(beer_id):
     if not current_user.is_authenticated:
         flash("Vous devez vous identifier pour commenter.")
@@ -950,7 +1642,7 @@ def add_comment(beer_id):
     return render_template("comment-beer.html", form=form, beer=beer_to_be_commented)
 
 
-@app.route("/edit-comment/<int:comment_id>", methods=['GET', 'POST'])
+@route("/edit-comment/<int:comment_id>", methods=['GET', 'POST'])
 def edit_comment(comment_id):
     comment_to_edit = Comment.query.get(comment_id)
     comment_beer = comment_to_edit.comments_beer
@@ -964,7 +1656,7 @@ def edit_comment(comment_id):
     return render_template("comment-beer.html", form=form, beer=comment_beer)
 
 
-@app.route("/delete-comment/<int:comment_id>", methods=['GET', 'POST'])
+@route("/delete-comment/<int:comment_id>", methods=['GET', 'POST'])
 def delete_comment(comment_id):
     comment_to_delete = Comment.query.get(comment_id)
     comment_beer = comment_to_delete.comments_beer
@@ -973,17 +1665,40 @@ def delete_comment(comment_id):
     return redirect(url_for("beer", beer_id=comment_beer.id))
 
 
-@app.route("/contact", methods=['GET', 'POST'])
+@route("/avatar/<string:digest>")
+def avatar(digest):
+    return avatars.avatar_response(digest, request.args.get('s', 100, type=int), known=is_user_avatar(digest))
+
+
+# Hashes of the registered emails, so /avatar only fetches and stores the pictures of users.
+# A hash missing from the set reloads it at most once every AVATAR_DIGESTS_TTL seconds.
+AVATAR_DIGESTS_TTL = 60
+avatar_digests = {}
+
+
+def is_user_avatar(digest):
+    cached = avatar_digests.get('users')
+    if cached is None or (digest not in cached[1] and time.monotonic() - cached[0] > AVATAR_DIGESTS_TTL):
+        digests = {avatars.email_hash(email) for email in db.session.scalars(select(User.email)) if email}
+        cached = avatar_digests['users'] = (time.monotonic(), digests)
+    return digest in cached[1]
+
+
+@route("/contact", methods=['GET', 'POST'])
 def contact():
     return render_template("contact.html")
 
 
-@app.route("/order", methods=['GET', 'POST'])
+@route("/order", methods=['GET', 'POST'])
 def order():
     return render_template("order.html")
 
 
+@jobs.task('create_qr')
+@metrics.timed('qr_generation_duration_seconds')
 def create_qr(id):
+    import qrcode
+
     # Link for website
     input_data = f"http://www.tontonsbrasseurs.com/beer/{id}"
     # Creating an instance of qrcode
@@ -998,10 +1713,8 @@ def create_qr(id):
     pass
 
 
-Talisman(app, content_security_policy=None)
-
-
 if __name__ == "__main__":
+    app = create_app()
     with app.app_context():
         db.create_all()
     app.run(host='0.0.0.0', port=5001, debug=True)
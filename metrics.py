@@ -0,0 +1,204 @@
+import atexit
+import glob
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, current_app, g, request
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [500, 1000, 5000, 10000, 50000, 100000, 500000, 1000000]
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ("Request latency by Flask endpoint.", LATENCY_BUCKETS),
+    'http_response_size_bytes': ("Response body size by Flask endpoint.", SIZE_BUCKETS),
+    'db_time_seconds': ("Time spent in SQL per request by Flask endpoint.", LATENCY_BUCKETS),
+    'recalculate_beer_duration_seconds': ("Time to recompute the aggregates of a beer.", LATENCY_BUCKETS),
+    'qr_generation_duration_seconds': ("Time to generate a QR code.", LATENCY_BUCKETS),
+    'mail_send_duration_seconds': ("Time to send a mail.", LATENCY_BUCKETS),
+    'job_duration_seconds': ("Time to run a background job by task.", LATENCY_BUCKETS),
+}
+COUNTERS = {
+    'http_requests_total': "Requests by Flask endpoint and status code.",
+    'cache_requests_total': "Cache lookups by cache and result.",
+    'jobs_total': "Background jobs run by task and result.",
+}
+
+# Each process keeps its own samples and writes them to METRICS_DIR, /metrics sums the files
+# of every gunicorn worker.
+FLUSH_INTERVAL = 5
+
+samples = {}
+last_flush = 0.0
+metrics_dir = None
+# The jobs thread of a gunicorn worker records samples next to the requests.
+lock = threading.Lock()
+
+
+def label_key(labels):
+    return json.dumps(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    buckets = HISTOGRAMS[name][1]
+    with lock:
+        series = samples.setdefault(name, {}).setdefault(
+            label_key(labels), {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+
+def count(name, amount=1, **labels):
+    key = label_key(labels)
+    with lock:
+        series = samples.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with timer(name):
+                return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+def flush():
+    global last_flush
+    if metrics_dir is None:
+        return
+    path = os.path.join(metrics_dir, f"metrics-{os.getpid()}.json")
+    fd, tmp_path = tempfile.mkstemp(dir=metrics_dir, suffix='.tmp')
+    with lock:
+        data = json.dumps(samples)
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    last_flush = time.monotonic()
+
+
+def flush_if_due():
+    if time.monotonic() - last_flush > FLUSH_INTERVAL:
+        flush()
+
+
+def reset():
+    global last_flush
+    with lock:
+        samples.clear()
+    last_flush = 0.0
+
+
+def collect():
+    merged = {}
+    for path in glob.glob(os.path.join(metrics_dir, "metrics-*.json")):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, series in data.items():
+            target = merged.setdefault(name, {})
+            for key, value in series.items():
+                if name in HISTOGRAMS:
+                    total = target.setdefault(key, {'buckets': [0] * len(value['buckets']), 'sum': 0.0, 'count': 0})
+                    total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+                    total['sum'] += value['sum']
+                    total['count'] += value['count']
+                else:
+                    target[key] = target.get(key, 0) + value
+    return merged
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def render(merged):
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, series in sorted(merged.get(name, {}).items()):
+            labels = json.loads(key)
+            # Buckets are stored as "value <= bound" counts, which are already cumulative.
+            for bound, bucket_count in zip(buckets, series['buckets']):
+                lines.append(f"{name}_bucket{format_labels(labels + [['le', bound]])} {bucket_count}")
+            lines.append(f"{name}_bucket{format_labels(labels + [['le', '+Inf']])} {series['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {series['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {series['count']}")
+    for name, help_text in COUNTERS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(merged.get(name, {}).items()):
+            lines.append(f"{name}{format_labels(json.loads(key))} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    global metrics_dir
+    metrics_dir = os.environ.get("METRICS_DIR", os.path.join(app.instance_path, "metrics"))
+    os.makedirs(metrics_dir, exist_ok=True)
+    app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
+
+    # Samples taken in the gunicorn master before the fork belong to no worker.
+    os.register_at_fork(after_in_child=reset)
+    atexit.register(flush)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+        endpoint = request.endpoint or 'unknown'
+        observe('http_request_duration_seconds', time.perf_counter() - start, endpoint=endpoint)
+        observe('http_response_size_bytes', response.content_length or 0, endpoint=endpoint)
+        sql_stats = g.get('sql_stats')
+        if sql_stats is not None:
+            observe('db_time_seconds', sql_stats.seconds, endpoint=endpoint)
+        count('http_requests_total', endpoint=endpoint, status=response.status_code)
+        flush_if_due()
+        return response
+
+
+def metrics_view():
+    flush()
+    return Response(render(collect()), mimetype='text/plain; version=0.0.4')
+
+
+def authorized():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token is None:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode())
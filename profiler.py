@@ -0,0 +1,145 @@
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+from flask_login import current_user
+from werkzeug.utils import secure_filename
+
+PROFILE_HEADER = 'X-Profile'
+ROW_HEIGHT = 18
+
+
+class Sampler:
+    """Samples the call stack of one thread at a fixed interval from a background thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ','))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def save(profile_dir, endpoint, sampler, keep):
+    folder = os.path.join(profile_dir, secure_filename(endpoint))
+    os.makedirs(folder, exist_ok=True)
+    # Two samples of the same second, or of two processes, must not overwrite each other.
+    name = (f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{secrets.token_hex(3)}"
+            f"-{int(sampler.duration * 1000)}ms.folded")
+    with open(os.path.join(folder, name), 'w') as f:
+        for stack, count in sampler.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    prune(folder, keep)
+
+
+def prune(folder, keep):
+    # Only the newest profiles of each endpoint are kept, names start with their date.
+    names = sorted((name for name in os.listdir(folder) if name.endswith('.folded')), reverse=True)
+    for name in names[keep:]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles(profile_dir):
+    profiles = {}
+    if not os.path.isdir(profile_dir):
+        return profiles
+    for endpoint in sorted(os.listdir(profile_dir)):
+        folder = os.path.join(profile_dir, endpoint)
+        if os.path.isdir(folder):
+            profiles[endpoint] = sorted((name for name in os.listdir(folder) if name.endswith('.folded')),
+                                        reverse=True)
+    return profiles
+
+
+def load(profile_dir, endpoint, name):
+    path = os.path.join(profile_dir, secure_filename(endpoint), secure_filename(name))
+    stacks = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            stacks[stack] += int(count)
+    return stacks
+
+
+def flame_graph(stacks):
+    # Returns the rectangles of the flame graph as (left %, width %, depth, label, samples),
+    # plus the depth of the deepest stack, root frames at depth 0.
+    tree = {}
+    for stack, count in stacks.items():
+        node = tree
+        for name in stack.split(';'):
+            child = node.setdefault(name, {'count': 0, 'children': {}})
+            child['count'] += count
+            node = child['children']
+
+    total = sum(stacks.values()) or 1
+    rectangles = []
+
+    def walk(children, left, depth):
+        for name, child in sorted(children.items()):
+            width = child['count'] / total * 100
+            rectangles.append((left, width, depth, name, child['count']))
+            walk(child['children'], left, depth + 1)
+            left += width
+
+    walk(tree, 0.0, 0)
+    max_depth = max((rectangle[2] for rectangle in rectangles), default=0)
+    return rectangles, max_depth
+
+
+def init_app(app):
+    app.config['PROFILER_SAMPLE_RATE'] = float(os.environ.get("PROFILER_SAMPLE_RATE", 0))
+    app.config['PROFILER_INTERVAL_MS'] = float(os.environ.get("PROFILER_INTERVAL_MS", 5))
+    app.config['PROFILE_DIR'] = os.environ.get("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+    app.config['PROFILES_PER_ENDPOINT'] = int(os.environ.get("PROFILES_PER_ENDPOINT", 20))
+
+    @app.before_request
+    def start_profiler():
+        rate = app.config['PROFILER_SAMPLE_RATE']
+        sampled = rate > 0 and random.random() < rate
+        if not sampled and PROFILE_HEADER in request.headers:
+            sampled = current_user.is_authenticated and current_user.is_admin
+        if sampled:
+            g.sampler = Sampler(threading.get_ident(), app.config['PROFILER_INTERVAL_MS'] / 1000)
+            g.sampler.start()
+
+    @app.teardown_request
+    def stop_profiler(exception):
+        sampler = g.pop('sampler', None)
+        if sampler is not None:
+            sampler.stop()
+            if sampler.stacks:
+                save(app.config['PROFILE_DIR'], request.endpoint or 'unknown', sampler,
+                     app.config['PROFILES_PER_ENDPOINT'])
@@ -0,0 +1,191 @@
+import fcntl
+import os
+
+import numpy as np
+
+# Order of the integer attributes stored for each review.
+ATTRIBUTES = [
+    'mousse', 'couleur', 'opacite', 'petillant', 'douceur', 'amertume', 'acidite', 'gushing',
+    'alcooleux', 'fruite', 'floral', 'houblonne', 'boise', 'torrefie', 'herbeux', 'cereales', 'epice',
+    'score',
+]
+
+# Value stored for an attribute left empty (NULL) in the Review table.
+MISSING = -1
+
+# One fixed-size record per review: the three ids followed by the int8 attribute matrix row.
+RECORD = np.dtype([
+    ('id', '<i4'),
+    ('beer_id', '<i4'),
+    ('author_id', '<i4'),
+    ('values', 'i1', (len(ATTRIBUTES),)),
+])
+
+_mapped = {}
+
+
+def to_record(review_id, beer_id, author_id, values):
+    record = np.zeros(1, dtype=RECORD)
+    record['id'] = review_id
+    record['beer_id'] = beer_id or 0
+    record['author_id'] = author_id or 0
+    record['values'] = [MISSING if value is None else value for value in values]
+    return record
+
+
+def from_review(review):
+    return to_record(review.id, review.beer_id, review.author_id,
+                     [getattr(review, attribute) for attribute in ATTRIBUTES])
+
+
+def from_row(row):
+    # row is an (id, beer_id, author_id, *ATTRIBUTES) tuple.
+    return to_record(row[0], row[1], row[2], row[3:])
+
+
+def refresh(path, rows, newer=None):
+    """Rebuilds the snapshot from rows sorted by id.
+
+    The new snapshot is written next to the old one and swapped in atomically, workers
+    still mapping the previous file keep reading it until they reload. Reviews appended
+    to the previous file meanwhile are lost with it: newer(last_id) is then asked for the
+    rows above the last one written, which are appended to the new file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    count = 0
+    last_id = 0
+    with open(tmp_path, 'wb') as f:
+        for row in rows:
+            f.write(from_row(row).tobytes())
+            last_id = row[0]
+            count += 1
+    os.replace(tmp_path, path)
+    if newer is not None:
+        count += _append_records(path, [from_row(row) for row in newer(last_id)])
+    return count
+
+
+def _append_records(path, records):
+    # The file stays sorted by id: under the lock, only records above the last id are written,
+    # the others (a review committed out of order, or already there) wait for the next refresh.
+    fd = os.open(path, os.O_RDWR | os.O_APPEND)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        size = os.fstat(fd).st_size
+        last_id = 0
+        if size >= RECORD.itemsize:
+            last_id = np.frombuffer(os.pread(fd, RECORD.itemsize, size - size % RECORD.itemsize - RECORD.itemsize),
+                                    dtype=RECORD)['id'][0]
+        data = []
+        for record in sorted(records, key=lambda record: record['id'][0]):
+            if record['id'][0] > last_id:
+                data.append(record.tobytes())
+                last_id = record['id'][0]
+        if data:
+            os.write(fd, b''.join(data))
+        return len(data)
+    finally:
+        os.close(fd)
+
+
+def append(path, reviews):
+    # Nothing is done until a first snapshot has been built with refresh().
+    if not os.path.exists(path):
+        return
+    _append_records(path, [from_review(review) for review in reviews])
+
+
+def _locate(matrix, review_id):
+    index = np.searchsorted(matrix['id'], review_id)
+    if index < len(matrix) and matrix['id'][index] == review_id:
+        return index
+    return None
+
+
+def update(path, review):
+    if not os.path.exists(path):
+        return
+    matrix = np.memmap(path, dtype=RECORD, mode='r+', shape=(os.path.getsize(path) // RECORD.itemsize,))
+    index = _locate(matrix, review.id)
+    if index is not None:
+        matrix[index] = from_review(review)[0]
+        matrix.flush()
+    elif not len(matrix) or review.id > matrix['id'][-1]:
+        append(path, [review])
+    # An older review missing from the file was lost in a refresh, the next one brings it back.
+
+
+def discard(path, review_ids):
+    # Deleted reviews are blanked in place, the next refresh() drops them for good.
+    if not os.path.exists(path) or not len(review_ids):
+        return
+    matrix = np.memmap(path, dtype=RECORD, mode='r+', shape=(os.path.getsize(path) // RECORD.itemsize,))
+    review_ids = np.asarray(review_ids, dtype=matrix['id'].dtype)
+    indexes = np.searchsorted(matrix['id'], review_ids)
+    found = indexes < len(matrix)
+    found[found] = matrix['id'][indexes[found]] == review_ids[found]
+    if found.any():
+        matrix['values'][indexes[found]] = MISSING
+        matrix.flush()
+
+
+def load(path):
+    # Read-only mapping shared through the page cache by every gunicorn worker.
+    # The mapping is reopened when the file has been replaced or has grown.
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=RECORD)
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size)
+    cached = _mapped.get(path)
+    if cached is None or cached[0] != key:
+        count = stat.st_size // RECORD.itemsize
+        if count == 0:
+            matrix = np.zeros(0, dtype=RECORD)
+        else:
+            matrix = np.memmap(path, dtype=RECORD, mode='r', shape=(count,))
+        cached = (key, matrix)
+        _mapped[path] = cached
+    return cached[1]
+
+
+# ANALYTICS
+def distributions(matrix, max_value=10):
+    values = matrix['values']
+    result = {}
+    for i, attribute in enumerate(ATTRIBUTES):
+        column = values[:, i]
+        column = column[column != MISSING]
+        result[attribute] = np.bincount(column, minlength=max_value + 1)[:max_value + 1].tolist()
+    return result
+
+
+def correlations(matrix):
+    values = matrix['values']
+    complete = values[(values != MISSING).all(axis=1)]
+    if len(complete) < 2:
+        return None
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.corrcoef(complete.astype(np.float32), rowvar=False)
+    return np.nan_to_num(corr).round(2).tolist()
+
+
+def author_bias(matrix, limit=20):
+    # Mean difference between an author's score and the average score of the beers they reviewed.
+    score = matrix['values'][:, ATTRIBUTES.index('score')].astype(np.float64)
+    rated = score != MISSING
+    beer_ids = matrix['beer_id'][rated]
+    author_ids = matrix['author_id'][rated]
+    score = score[rated]
+    if len(score) == 0:
+        return []
+
+    beers, beer_index = np.unique(beer_ids, return_inverse=True)
+    beer_mean = np.bincount(beer_index, weights=score) / np.bincount(beer_index)
+    deviation = score - beer_mean[beer_index]
+
+    authors, author_index = np.unique(author_ids, return_inverse=True)
+    counts = np.bincount(author_index)
+    bias = np.bincount(author_index, weights=deviation) / counts
+
+    order = np.argsort(-np.abs(bias))[:limit]
+    return [(int(authors[i]), round(float(bias[i]), 2), int(counts[i])) for i in order]
@@ -0,0 +1,141 @@
+"""Static copies of the public pages, as an anonymous visitor gets them.
+
+Pages are rendered through the app into SNAPSHOT_DIR as <path>/index.html, with
+.gz (and .br) siblings, so nginx can answer anonymous visitors before gunicorn:
+
+    location / {
+        if ($http_cookie ~ "session|remember_token") { proxy_pass http://app; }
+        gzip_static on;
+        try_files /snapshot$uri/index.html @app;
+    }
+
+A manifest keeps the version each page was rendered from, so a refresh only renders
+the pages whose version changed and removes those that no longer exist.
+
+Where no nginx stands in front of the app, SNAPSHOT_SERVE=1 has the app answer anonymous
+visitors from the snapshot before any view runs, as the location above does.
+"""
+import gzip
+import json
+import os
+import tempfile
+
+from flask import current_app, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+BASE_URL = 'https://localhost'
+# Marks the requests of sync(), which must reach the views rather than the previous snapshot.
+RENDERING = 'snapshot.rendering'
+
+
+def page_folder(path):
+    return os.path.join(current_app.config['SNAPSHOT_DIR'], *path.strip('/').split('/'))
+
+
+def write(folder, name, body):
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, os.path.join(folder, name))
+
+
+def store(path, body):
+    folder = page_folder(path)
+    os.makedirs(folder, exist_ok=True)
+    write(folder, 'index.html.gz', gzip.compress(body, 9, mtime=0))
+    if brotli is not None:
+        write(folder, 'index.html.br', brotli.compress(body))
+    write(folder, 'index.html', body)
+
+
+def remove(path):
+    folder = page_folder(path)
+    for name in ('index.html', 'index.html.gz', 'index.html.br'):
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+
+
+def load_manifest():
+    try:
+        with open(os.path.join(current_app.config['SNAPSHOT_DIR'], MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def sync(pages, full=False):
+    """Renders the pages, a {path: version} dict, whose version changed since the last run.
+
+    Returns the number of pages rendered and removed.
+    """
+    folder = current_app.config['SNAPSHOT_DIR']
+    os.makedirs(folder, exist_ok=True)
+    previous = load_manifest()
+    manifest = {} if full else dict(previous)
+    versions = {path: f"{current_app.config['TEMPLATES_DIGEST']}:{version}" for path, version in pages.items()}
+
+    client = current_app.test_client(use_cookies=False)
+    rendered = 0
+    for path, version in versions.items():
+        if manifest.get(path) == version:
+            continue
+        response = client.get(path, base_url=BASE_URL, environ_overrides={RENDERING: True})
+        if response.status_code == 200:
+            store(path, response.get_data())
+            manifest[path] = version
+            rendered += 1
+        else:
+            remove(path)
+            manifest.pop(path, None)
+    removed = [path for path in previous if path not in versions]
+    for path in removed:
+        remove(path)
+        manifest.pop(path, None)
+
+    write(folder, MANIFEST, json.dumps(manifest, indent=0, sort_keys=True).encode())
+    return rendered, len(removed)
+
+
+def serve():
+    if request.method not in ('GET', 'HEAD') or request.query_string or request.environ.get(RENDERING):
+        return None
+    if not (request.is_secure or request.headers.get('X-Forwarded-Proto') == 'https'):
+        return None
+    # Visitors with a session may be logged in and see their own version of the pages.
+    cookies = (current_app.config['SESSION_COOKIE_NAME'],
+               current_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+    if any(name in request.cookies for name in cookies):
+        return None
+    path = safe_join(current_app.config['SNAPSHOT_DIR'], *request.path.strip('/').split('/'), 'index.html')
+    if path is None:
+        return None
+    for suffix, encoding in (('.br', 'br'), ('.gz', 'gzip'), ('', None)):
+        if encoding and not request.accept_encodings[encoding]:
+            continue
+        if os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype='text/html', conditional=True)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+def init_app(app):
+    # Snapshots are only kept when SNAPSHOT_DIR is set.
+    app.config.setdefault('SNAPSHOT_DIR', os.environ.get("SNAPSHOT_DIR"))
+    app.config.setdefault('SNAPSHOT_SERVE', os.environ.get("SNAPSHOT_SERVE") == "1")
+
+    @app.before_request
+    def serve_snapshot():
+        # Eager jobs never refresh the snapshot, it would go stale.
+        if app.config['SNAPSHOT_DIR'] and app.config['SNAPSHOT_SERVE'] and not app.config.get('JOBS_EAGER'):
+            return serve()
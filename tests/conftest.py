@@ -0,0 +1,46 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import review_matrix  # noqa: E402
+from main import Beer, create_app, db  # noqa: E402
+
+BASE_URL = "https://localhost"
+
+
+def new_beer(name, **columns):
+    return Beer(**{'name': name, 'type': "Blonde", 'version': 1, 'date': datetime.datetime(2024, 1, 1),
+                   'malt': "", 'houblon': "", 'description': "", 'score': 0,
+                   **dict.fromkeys(review_matrix.ATTRIBUTES, 0), **columns})
+
+
+def make_app(tmp_path, **config):
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'WTF_CSRF_ENABLED': False,
+        'SQLITE_TUNED': False,
+        'JOBS_EAGER': False,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path}/primary.db",
+        'JINJA_CACHE_DIR': str(tmp_path / "jinja"),
+        'REVIEW_MATRIX_PATH': str(tmp_path / "review-matrix.bin"),
+        'AVATAR_CACHE_DIR': str(tmp_path / "avatars"),
+        **config,
+    })
+
+
+@pytest.fixture(autouse=True)
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("METRICS_DIR", str(tmp_path / "metrics"))
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path)
+    with app.app_context():
+        db.create_all(bind_key=None)
+    return app
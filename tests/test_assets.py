@@ -0,0 +1,27 @@
+"""Fingerprinted assets and their cache headers."""
+import assets
+from conftest import BASE_URL, make_app
+
+
+def test_only_fingerprinted_files_are_immutable(tmp_path):
+    static = tmp_path / "static"
+    templates = tmp_path / "templates"
+    (static / "css").mkdir(parents=True)
+    templates.mkdir()
+    (static / "css" / "styles.css").write_text("body { color: black; }" * 50)
+    (templates / "base.html").write_text("{{ url_for('static', filename='css/styles.css') }}")
+    manifest = assets.build(str(static), str(templates))
+
+    app = make_app(tmp_path)
+    app.static_folder = str(static)
+    app.wsgi_app = assets.PrecompressedStatic(app.wsgi_app, app.static_folder, app.static_url_path)
+    client = app.test_client()
+
+    response = client.get(f"/static/{manifest['css/styles.css']}", base_url=BASE_URL)
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+
+    response = client.get(f"/static/{assets.DIST_FOLDER}/{assets.MANIFEST}", base_url=BASE_URL)
+    assert response.status_code == 200
+    assert not response.cache_control.immutable
+    response.close()
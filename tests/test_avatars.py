@@ -0,0 +1,82 @@
+"""Avatar cache against the stand-in origin of benchmarks/avatar_origin.py."""
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import avatars  # noqa: E402
+from avatar_origin import Handler  # noqa: E402
+from conftest import BASE_URL  # noqa: E402
+
+# The stand-in has a picture for hashes starting with an even digit, a 404 for the others.
+WITH_PICTURE = 'a' * 64
+WITHOUT_PICTURE = 'b' * 64
+
+
+@pytest.fixture
+def origin():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/avatar"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def avatar_app(app, origin):
+    app.config['AVATAR_ORIGIN'] = origin
+    return app
+
+
+def get(app, digest, known=True, headers=None):
+    with app.test_request_context(f'/avatar/{digest}', base_url=BASE_URL, headers=headers):
+        return avatars.avatar_response(digest, 100, known=known)
+
+
+def cached(app):
+    return sorted(os.listdir(app.config['AVATAR_CACHE_DIR']))
+
+
+def test_picture_is_fetched_cached_and_validated(avatar_app):
+    response = get(avatar_app, WITH_PICTURE)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert cached(avatar_app) == [f"{WITH_PICTURE}-100.png"]
+
+    revalidated = get(avatar_app, WITH_PICTURE, headers={'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
+
+
+def test_missing_picture_falls_back_to_a_stored_identicon(avatar_app):
+    response = get(avatar_app, WITHOUT_PICTURE)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'image/svg+xml'
+    assert cached(avatar_app) == [f"{WITHOUT_PICTURE}-100.svg"]
+
+
+def test_unreachable_origin_falls_back_to_the_stale_copy(avatar_app):
+    get(avatar_app, WITH_PICTURE)
+    avatar_app.config.update(AVATAR_ORIGIN="http://127.0.0.1:1/avatar", AVATAR_MAX_AGE=0)
+
+    response = get(avatar_app, WITH_PICTURE)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert cached(avatar_app) == [f"{WITH_PICTURE}-100.png"]
+
+
+def test_unknown_hash_is_neither_fetched_nor_stored(avatar_app, monkeypatch):
+    monkeypatch.setattr(avatars, 'fetch', lambda digest, size: pytest.fail("fetched an unknown hash"))
+
+    response = get(avatar_app, WITH_PICTURE, known=False)
+
+    assert response.status_code == 200
+    assert response.mimetype == 'image/svg+xml'
+    assert cached(avatar_app) == []
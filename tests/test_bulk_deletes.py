@@ -0,0 +1,95 @@
+"""Set-based deletes, which rely on ON DELETE CASCADE and recompute what they touch."""
+import os
+import sys
+
+import pytest
+from sqlalchemy import func, select
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import review_matrix  # noqa: E402
+from conftest import BASE_URL  # noqa: E402
+from datagen import PASSWORD, generate, user_email  # noqa: E402
+from main import CATALOGUE, Beer, Comment, Review, Revision, User, db, touch_catalogue  # noqa: E402
+
+
+@pytest.fixture
+def admin(app):
+    with app.app_context():
+        generate(db, beers=6, users=6, reviews=30, comments=12, max_versions=2, log=lambda _: None)
+        # Start from a known catalogue revision, datagen writes around the session hooks.
+        touch_catalogue(db.session)
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'email': user_email(0), 'password': PASSWORD}, base_url=BASE_URL)
+    return client
+
+
+def catalogue_revision():
+    return db.session.get(Revision, CATALOGUE).value
+
+
+def orphans():
+    reviews = db.session.scalar(select(func.count(Review.id)).where(
+        Review.beer_id.not_in(select(Beer.id)) | Review.author_id.not_in(select(User.id))))
+    comments = db.session.scalar(select(func.count(Comment.id)).where(
+        Comment.beer_id.not_in(select(Beer.id)) | Comment.author_id.not_in(select(User.id))))
+    return reviews, comments
+
+
+def averages(beer_id):
+    row = db.session.execute(select(*[func.avg(getattr(Review, attribute)) for attribute in review_matrix.ATTRIBUTES])
+                             .where(Review.beer_id == beer_id)).one()
+    return [value or 0 for value in row]
+
+
+def stored_averages(beer_id):
+    beer = db.session.get(Beer, beer_id)
+    return [getattr(beer, attribute) for attribute in review_matrix.ATTRIBUTES]
+
+
+def test_deleting_beers_removes_their_reviews_and_comments(app, admin):
+    with app.app_context():
+        deleted = db.session.get(Beer, 1)
+        siblings = {beer.id: beer.revision for beer in Beer.query.filter(Beer.name == deleted.name, Beer.id != 1)}
+        before = catalogue_revision()
+        assert db.session.scalar(select(func.count(Review.id)).where(Review.beer_id == 1))
+
+    admin.post('/admin-delete-beers', data={'ids': [1]}, base_url=BASE_URL)
+
+    with app.app_context():
+        assert db.session.get(Beer, 1) is None
+        assert orphans() == (0, 0)
+        assert catalogue_revision() > before
+        for beer_id, revision in siblings.items():
+            assert db.session.get(Beer, beer_id).revision > revision
+
+
+def test_deleting_users_recalculates_the_beers_they_reviewed(app, admin):
+    with app.app_context():
+        user_ids = [2, 3]
+        reviewed = set(db.session.scalars(select(Review.beer_id).where(Review.author_id.in_(user_ids))))
+        revisions = {beer_id: db.session.get(Beer, beer_id).revision for beer_id in reviewed}
+        before = catalogue_revision()
+        assert reviewed
+
+    admin.post('/admin-delete-users', data={'ids': [1, *user_ids]}, base_url=BASE_URL)
+
+    with app.app_context():
+        assert db.session.get(User, 1) is not None
+        assert all(db.session.get(User, user_id) is None for user_id in user_ids)
+        assert orphans() == (0, 0)
+        assert catalogue_revision() > before
+        for beer_id in reviewed:
+            assert db.session.get(Beer, beer_id).revision > revisions[beer_id]
+            assert stored_averages(beer_id)[:-1] == pytest.approx(averages(beer_id)[:-1])
+
+
+def test_admins_cannot_revoke_their_own_rights(app, admin):
+    admin.post('/admin-edit-users', data={'ids': [1, 2], 'action': 'grant'}, base_url=BASE_URL)
+    admin.post('/admin-edit-users', data={'ids': [1, 2], 'action': 'revoke'}, base_url=BASE_URL)
+    admin.get('/admin-edit-user/1', base_url=BASE_URL)
+
+    with app.app_context():
+        assert db.session.get(User, 1).is_admin
+        assert not db.session.get(User, 2).is_admin
@@ -0,0 +1,9 @@
+"""Validators of the pages answered with 304."""
+import conditional
+
+
+def test_digest_follows_the_asset_manifest(app):
+    before = conditional.template_digest(app)
+    app.config['ASSET_MANIFEST'] = {'css/styles.css': 'dist/css/styles.0123456789ab.css'}
+
+    assert conditional.template_digest(app) != before
@@ -0,0 +1,37 @@
+"""The worker loop, as run in a thread of each gunicorn worker."""
+from sqlalchemy.exc import OperationalError
+
+import jobs
+from main import db
+
+
+def test_worker_survives_a_failed_iteration(app, monkeypatch):
+    app.config.update(JOBS_POLL_SECONDS=0, JOBS_BACKOFF_SECONDS=0)
+    stopping = []
+    done = []
+
+    def stop_worker():
+        done.append(True)
+        stopping.append(True)
+
+    claim = jobs.claim
+    failures = []
+
+    def flaky_claim(worker):
+        if not failures:
+            failures.append(worker)
+            raise OperationalError("SELECT", {}, Exception("server closed the connection unexpectedly"))
+        return claim(worker)
+
+    monkeypatch.setitem(jobs.tasks, 'test_stop_worker', (stop_worker, 0, 1))
+    monkeypatch.setattr(jobs, 'claim', flaky_claim)
+    with app.app_context():
+        jobs.enqueue('test_stop_worker')
+        db.session.commit()
+
+    jobs.work(app, stopping=stopping)
+
+    assert failures
+    assert done
+    with app.app_context():
+        assert jobs.status_counts()['done'] == 1
@@ -0,0 +1,36 @@
+"""Stored profiles: names, retention and listing."""
+from collections import Counter
+
+import profiler
+
+
+class FinishedSampler:
+    duration = 0.012
+    stacks = Counter({'main (main.py:1);view (main.py:10)': 3})
+
+
+def test_profiles_of_the_same_second_are_all_kept(tmp_path):
+    for _ in range(3):
+        profiler.save(str(tmp_path), 'beer', FinishedSampler(), keep=10)
+
+    assert len(profiler.list_profiles(str(tmp_path))['beer']) == 3
+
+
+def test_only_the_newest_profiles_are_kept(tmp_path):
+    folder = tmp_path / 'beer'
+    folder.mkdir()
+    for day in range(1, 6):
+        (folder / f"2024010{day}-120000-1-abcdef-10ms.folded").write_text("main 1\n")
+
+    profiler.save(str(tmp_path), 'beer', FinishedSampler(), keep=3)
+
+    names = profiler.list_profiles(str(tmp_path))['beer']
+    assert len(names) == 3
+    assert names[1:] == ["20240105-120000-1-abcdef-10ms.folded", "20240104-120000-1-abcdef-10ms.folded"]
+
+
+def test_stray_files_are_not_listed(tmp_path):
+    (tmp_path / '.DS_Store').write_text("")
+    profiler.save(str(tmp_path), 'beer', FinishedSampler(), keep=10)
+
+    assert list(profiler.list_profiles(str(tmp_path))) == ['beer']
@@ -0,0 +1,95 @@
+"""Read routing between the primary and the replica, on two SQLite files."""
+import datetime
+import shutil
+
+import pytest
+from flask import g
+from sqlalchemy import event, select
+
+import database
+from conftest import BASE_URL, make_app, new_beer
+from main import Beer, User, db
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path, SQLALCHEMY_BINDS={database.REPLICA: {'url': f"sqlite:///{tmp_path}/replica.db"}})
+    with app.app_context():
+        db.create_all(bind_key=None)
+        db.session.add(new_beer("Blonde du primaire et du réplica"))
+        db.session.commit()
+        db.engines[None].dispose()
+    # The replica starts as a copy, then only the primary receives the next writes.
+    shutil.copy(tmp_path / "primary.db", tmp_path / "replica.db")
+    with app.app_context():
+        db.session.add(new_beer("Ambrée du primaire seul"))
+        db.session.commit()
+    return app
+
+
+@pytest.fixture
+def statements(app):
+    executed = {'primary': [], 'replica': []}
+    with app.app_context():
+        for bind_key, engine in db.engines.items():
+            name = bind_key or 'primary'
+            event.listen(engine, 'before_cursor_execute',
+                         lambda *args, name=name: executed[name].append(args[2].split()[0].upper()))
+    return executed
+
+
+def register(client):
+    return client.post('/register', data={'email': 'lecteur@example.com', 'password': 'secret',
+                                          'name': 'Jeanne', 'surname': 'Piron'}, base_url=BASE_URL)
+
+
+def test_replica_reads_views_read_the_replica(app, statements):
+    response = app.test_client().get('/beers/note', base_url=BASE_URL)
+
+    assert response.status_code == 200
+    assert "Blonde du primaire et du réplica" in response.text
+    assert "Ambrée du primaire seul" not in response.text
+    assert statements['replica']
+    assert not statements['primary']
+
+
+def test_posts_write_to_the_primary(app, statements):
+    response = register(app.test_client())
+
+    assert response.status_code == 302
+    assert 'INSERT' in statements['primary']
+    assert not statements['replica']
+    with app.app_context():
+        assert db.session.scalar(select(User.email)) == 'lecteur@example.com'
+        with db.engines[database.REPLICA].connect() as replica:
+            assert replica.scalar(select(User.email)) is None
+
+
+def test_flushes_go_to_the_primary(app, statements):
+    with app.test_request_context('/beers/note', base_url=BASE_URL):
+        g.use_replica = True
+        assert len(db.session.scalars(select(Beer)).all()) == 1
+        db.session.add(new_beer("Brune du primaire seul"))
+        db.session.flush()
+        # Once the session wrote, its reads stay on the primary.
+        assert len(db.session.scalars(select(Beer)).all()) == 3
+        db.session.rollback()
+
+    assert 'INSERT' in statements['primary']
+    assert 'INSERT' not in statements['replica']
+
+
+def test_writer_is_pinned_to_the_primary(app, statements):
+    client = app.test_client()
+    register(client)
+    with client.session_transaction() as session:
+        assert session['primary_until'] > datetime.datetime.now().timestamp()
+    statements['primary'].clear()
+    statements['replica'].clear()
+
+    response = client.get('/beers/note', base_url=BASE_URL)
+
+    assert response.status_code == 200
+    assert "Ambrée du primaire seul" in response.text
+    assert statements['primary']
+    assert not statements['replica']
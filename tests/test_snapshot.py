@@ -0,0 +1,57 @@
+"""Snapshot refreshes and serving, with the app answering anonymous visitors from the snapshot."""
+import os
+
+import pytest
+
+from conftest import BASE_URL, make_app, new_beer
+from main import Beer, db, refresh_snapshot
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path, SNAPSHOT_DIR=str(tmp_path / "snapshot"), SNAPSHOT_SERVE=True)
+    with app.app_context():
+        db.create_all(bind_key=None)
+        db.session.add(new_beer("Alpha"))
+        db.session.commit()
+        refresh_snapshot()
+    return app
+
+
+def snapshot_page(app, path):
+    with open(os.path.join(app.config['SNAPSHOT_DIR'], *path.strip('/').split('/'), 'index.html')) as f:
+        return f.read()
+
+
+def rename_beer(app, name):
+    with app.app_context():
+        db.session.get(Beer, 1).name = name
+        db.session.commit()
+
+
+def test_refresh_renders_the_views_not_the_previous_snapshot(app):
+    rename_beer(app, "Omega")
+    with app.app_context():
+        rendered, removed = refresh_snapshot()
+
+    assert rendered > 0
+    assert "Omega" in snapshot_page(app, '/beer/1')
+    assert "Alpha" not in snapshot_page(app, '/beer/1')
+
+
+def test_anonymous_visitors_get_the_snapshot(app):
+    rename_beer(app, "Omega")
+
+    response = app.test_client(use_cookies=False).get('/beer/1', base_url=BASE_URL)
+
+    assert response.status_code == 200
+    assert "Alpha" in response.text
+
+
+def test_snapshot_is_not_served_with_eager_jobs(app):
+    app.config['JOBS_EAGER'] = True
+    rename_beer(app, "Omega")
+
+    response = app.test_client(use_cookies=False).get('/beer/1', base_url=BASE_URL)
+
+    assert "Omega" in response.text